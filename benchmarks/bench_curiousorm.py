@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+## The author disclaims copyright to this source code.  In place of
+## a legal notice, here is a poem:
+##
+##   "Metaphysics"
+##   
+##   Matter: is the music 
+##   of the space.
+##   Music: is the matter
+##   of the soul.
+##   
+##   Soul: is the space
+##   of God.
+##   Space: is the soul
+##   of logic.
+##   
+##   Logic: is the god
+##   of the mind.
+##   God: is the logic
+##   of bliss.
+##   
+##   Bliss: is a mind
+##   of music.
+##   Mind: is the bliss
+##   of the matter.
+##   
+######################################################################
+## This file implements a micro-benchmark for the dynamic method
+## dispatch of the object-relational mapper.
+##
+import sys, os, getopt, json
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cmbarter.modules import curiousorm
+
+
+USAGE = """Usage: bench_curiousorm.py [OPTIONS]
+Measures how many dynamically dispatched calls like "db.get_userinfo()"
+and "db.select_offer_list()" the mapper can make per second, and
+reports the results as JSON. No database connection is made -- the
+called methods return immediately, so that only the dispatch is
+measured.
+
+  -h, --help
+         Display this help and exit.
+
+  --calls=INTEGER
+         The number of calls made in each case (default: 1000000).
+
+Example:
+  $ ./bench_curiousorm.py --calls=100000
+"""
+
+
+class DummyMapper(curiousorm.AbstractMapper):
+    def execute(self, query, values=[], onerow=False):
+        return None
+
+    def callproc(self, name, args=[], onerow=False):
+        return None
+
+
+class DeclaredDummyMapper(DummyMapper):
+    pass
+
+
+
+def measure(f):
+    started_at = time()
+    for i in xrange(calls):
+        f(i)
+    return round(calls / (time() - started_at))
+
+
+
+def run_cases():
+    m = DummyMapper()
+    results = {
+        'stored_procedure': measure(lambda i: m.get_userinfo(i)),
+        'select_list': measure(lambda i: m.select_offer_list(issuer_id=i)),
+        'new_mapper': measure(lambda i: DummyMapper().get_userinfo(i)),
+        }
+
+    # Methods can be declared only after the dispatch cache was added.
+    if hasattr(curiousorm.AbstractMapper, 'declare'):
+        DeclaredDummyMapper.declare('get_userinfo')
+        results['new_declared_mapper'] = measure(lambda i: DeclaredDummyMapper().get_userinfo(i))
+    return results
+
+
+
+def parse_args(argv):
+    global calls
+    try:                                
+        opts, args = getopt.gnu_getopt(argv, 'h', ['calls=', 'help'])
+    except getopt.GetoptError:
+        print(USAGE)
+        sys.exit(2)
+
+    if len(args) != 0:
+        print(USAGE)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print(USAGE)
+            sys.exit()                  
+        elif opt == '--calls':
+            try:
+                calls = int(arg)
+                if calls < 1:
+                    raise ValueError
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+
+
+
+if __name__ == "__main__":
+    # Read command-line parameters.
+    calls = 1000000
+    parse_args(sys.argv[1:])
+
+    print(json.dumps(run_cases(), indent=2, sort_keys=True))
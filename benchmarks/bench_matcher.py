@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+## The author disclaims copyright to this source code.  In place of
+## a legal notice, here is a poem:
+##
+##   "Metaphysics"
+##   
+##   Matter: is the music 
+##   of the space.
+##   Music: is the matter
+##   of the soul.
+##   
+##   Soul: is the space
+##   of God.
+##   Space: is the soul
+##   of logic.
+##   
+##   Logic: is the god
+##   of the mind.
+##   God: is the logic
+##   of bliss.
+##   
+##   Bliss: is a mind
+##   of music.
+##   Mind: is the bliss
+##   of the matter.
+##   
+######################################################################
+## This file implements a benchmark for the trading cycles matcher.
+##
+import sys, os, getopt, json, subprocess, resource, multiprocessing
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cmbarter.modules import matcher as matcher_module
+from cmbarter.modules.matcher import (
+    BondMatcher, CirculationBondMatcher, ParallelBondMatcher, generate_market,
+    CIRCULATION_MAX_BOND_COUNT)
+
+
+USAGE = """Usage: bench_matcher.py [OPTIONS]
+Runs the matcher over synthetic markets of different sizes, and
+reports the results as JSON.
+
+Every engine/size combination runs in a separate process, so that the
+reported peak memory usage is not influenced by the other runs. The
+circulation engine runs only for sizes up to %(max)i bonds, because
+bigger markets are matched greedily anyway.
+
+  -h, --help
+         Display this help and exit.
+
+  --sizes=INTEGER[,INTEGER...]
+         The numbers of bonds in the generated markets (default:
+         10000,100000,1000000,10000000). There are five bonds per
+         trader.
+
+  --engines=ENGINE[,ENGINE...]
+         The engines to benchmark: "greedy", "parallel" (the greedy
+         engine in several worker processes), and "circulation"
+         (default: greedy,parallel,circulation).
+
+  --jobs=INTEGER
+         The number of worker processes used by the parallel engine
+         (default: the number of CPUs, %(cpus)i).
+
+  --level=INTEGER
+         Bonds smaller than 10**level are ignored (default: 0).
+
+  --sellers-ratio=FLOAT
+         The part of the bonds that are offers to sell (default: 0.1).
+
+  --locality=INTEGER
+         How far in the list of traders the buyers of a product are
+         from its issuer (default: 10000).
+
+  --avg-amount=INTEGER
+         The average amount of a buy offer (default: 100).
+
+  --distribution=DISTRIBUTION
+         The distribution of bonds' amounts: "exponential" (the
+         default), or "uniform".
+
+  --seed=INTEGER
+         The seed for the random number generator (default: 1).
+
+  --mmap-dir=DIR
+         Keeps the bonds in memory-mapped temporary files in DIR. The
+         maximum circulation of the "circulation" engine is always
+         computed in RAM.
+
+Example:
+  $ ./bench_matcher.py --sizes=10000,100000 --engines=parallel --jobs=4
+""" % {'max': CIRCULATION_MAX_BOND_COUNT, 'cpus': multiprocessing.cpu_count()}
+
+
+ENGINES = {
+    'greedy': BondMatcher,
+    'parallel': BondMatcher,
+    'circulation': CirculationBondMatcher,
+    }
+
+
+
+def run_case(bond_count, engine):
+    if engine == 'parallel':
+        matcher = ParallelBondMatcher(10**level, jobs, ENGINES[engine], mmap_dir)
+    else:
+        matcher = ENGINES[engine](10**level, mmap_dir)
+
+    zero_time = time()
+    bonds = generate_market(
+        max(bond_count // 5, 1), bond_count, sellers_ratio, locality_distance,
+        avg_amount, distribution, seed)
+    for b in bonds:
+        matcher.register_bond(*b)
+    registration_time = time()
+
+    matcher.start()
+    deal_count = 0
+    cleared_amount = 0
+    while True:
+        deal = matcher.find_deal()
+        if not deal:
+            break
+        deal_count += 1
+        cleared_amount += len(deal[0]) * deal[1]
+    matching_time = time()
+
+    scanned_arc_count, skipped_arc_count = matcher.get_scan_stats()
+    return {
+        'engine': engine,
+        'bonds': bond_count,
+        'jobs': jobs if engine == 'parallel' else 1,
+        'native': matcher_module._lib is not None,
+        'mmap': mmap_dir is not None,
+        'deals': deal_count,
+        'cleared_amount': cleared_amount,
+        'scanned_arcs': scanned_arc_count,
+        'skipped_arcs': skipped_arc_count,
+        'registration_seconds': round(registration_time - zero_time, 3),
+        'matching_seconds': round(matching_time - registration_time, 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_worker_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+
+
+def parse_int_list(s):
+    values = [int(x) for x in s.split(',')]
+    if not values or min(values) < 1:
+        raise ValueError
+    return values
+
+
+
+def parse_args(argv):
+    global sizes, engines, jobs, level, sellers_ratio, locality_distance, avg_amount
+    global distribution, seed, mmap_dir, case
+    try:                                
+        opts, args = getopt.gnu_getopt(argv, 'h', [
+                'sizes=', 'engines=', 'jobs=', 'level=', 'sellers-ratio=', 'locality=',
+                'avg-amount=', 'distribution=', 'seed=', 'mmap-dir=', 'case=', 'help'])
+    except getopt.GetoptError:
+        print(USAGE)
+        sys.exit(2)
+
+    if len(args) != 0:
+        print(USAGE)
+        sys.exit(2)
+
+    try:
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                print(USAGE)
+                sys.exit()                  
+            elif opt == '--sizes':
+                sizes = parse_int_list(arg)
+            elif opt == '--engines':
+                engines = arg.split(',')
+                if not set(engines) <= set(ENGINES):
+                    raise ValueError
+            elif opt == '--jobs':
+                jobs = parse_int_list(arg)[0]
+            elif opt == '--level':
+                level = max(int(arg), 0)
+            elif opt == '--sellers-ratio':
+                sellers_ratio = float(arg)
+                if not 0 < sellers_ratio < 1:
+                    raise ValueError
+            elif opt == '--locality':
+                locality_distance = parse_int_list(arg)[0]
+            elif opt == '--avg-amount':
+                avg_amount = parse_int_list(arg)[0]
+            elif opt == '--distribution':
+                if arg not in ('exponential', 'uniform'):
+                    raise ValueError
+                distribution = arg
+            elif opt == '--seed':
+                seed = int(arg)
+            elif opt == '--mmap-dir':
+                mmap_dir = arg
+            elif opt == '--case':
+                # Used internally, to run a single engine/size combination.
+                bond_count, engine = arg.split(':')
+                case = int(bond_count), engine
+    except ValueError:
+        print(USAGE)
+        sys.exit(2)
+
+
+
+if __name__ == "__main__":
+    # Read command-line parameters.
+    sizes = [10**4, 10**5, 10**6, 10**7]
+    engines = ['greedy', 'parallel', 'circulation']
+    jobs = multiprocessing.cpu_count()
+    level = 0
+    sellers_ratio = 0.1
+    locality_distance = 10000
+    avg_amount = 100
+    distribution = 'exponential'
+    seed = 1
+    mmap_dir = None
+    case = None
+    parse_args(sys.argv[1:])
+
+    if case:
+        print(json.dumps(run_case(*case)))
+    else:
+        results = []
+        for bond_count in sizes:
+            for engine in engines:
+                if engine == 'circulation' and bond_count > CIRCULATION_MAX_BOND_COUNT:
+                    continue
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                    ['--case=%i:%s' % (bond_count, engine)])
+                results.append(json.loads(output.decode('ascii')))
+        print(json.dumps(results, indent=2, sort_keys=True))
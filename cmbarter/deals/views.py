@@ -45,7 +45,8 @@ from cmbarter.modules import curiousorm, utils
 import pytz
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 HISTORY_HORIZON = datetime.timedelta(days=settings.CMBARTER_HISTORY_HORISON_DAYS)
 DEAL_FIELD = re.compile(r'^deal-([0-9]{1,9})-([0-9]{1,9})-([0-9]{1,9})$')
@@ -46,7 +46,8 @@ from cmbarter.deposits import forms
 from cmbarter.modules import curiousorm, utils
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 TRX_FIELD = re.compile(r'^trx-([0-9]{1,15})$')
 HANDOFF_FIELD = re.compile(r'^handoff-([0-9]{1,9})$')
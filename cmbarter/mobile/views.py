@@ -52,7 +52,8 @@ import cmbarter.orders.forms
 import cmbarter.deposits.forms
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 TRX_FIELD = re.compile(r'^trx-([0-9]{1,15})$')
 HANDOFF_FIELD = re.compile(r'^handoff-([0-9]{1,9})$')
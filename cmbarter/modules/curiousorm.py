@@ -28,7 +28,7 @@
 ## object-relational mapper.
 ##
 from contextlib import contextmanager
-from functools import wraps
+from functools import wraps, partial
 import time, threading, collections
 
 # Try to import psycopg2. If not possible, try psycopg2cffi.
@@ -45,9 +45,11 @@ except ImportError:
 
 import psycopg2.extensions
 from psycopg2.extras import DictCursor, NamedTupleCursor
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import (ISOLATION_LEVEL_AUTOCOMMIT,
+                                  TRANSACTION_STATUS_IDLE)
 from psycopg2.errorcodes import (SERIALIZATION_FAILURE, DEADLOCK_DETECTED,
-                                 RAISE_EXCEPTION)
+                                 RAISE_EXCEPTION, INVALID_SQL_STATEMENT_NAME,
+                                 FEATURE_NOT_SUPPORTED)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
 
@@ -137,6 +139,206 @@ class MultipleRowsError(Exception):
     """A single row was expected, but multiple were encountered."""
 
 
+class PoolTimeoutError(Exception):
+    """No pooled connection became available in time."""
+
+
+class _StatementCache(object):
+    """The stored procedure calls prepared on a given connection.
+
+    Every distinct (procedure name, number of arguments) pair gets
+    prepared once, and is executed after that. When the cache gets
+    full, the least recently used statement gets deallocated. A
+    prepared statement is bound to the procedure chosen when it was
+    prepared, so procedures that are overloaded with the same number
+    of arguments (or called with some of their arguments omitted) are
+    never prepared. They are called directly, like without a cache.
+    """
+
+    def __init__(self, size):
+        assert size > 0
+        self.size = size
+        self._statements = collections.OrderedDict()
+        self._unprepared_keys = set()
+        self._counter = 0
+
+    def clear(self):
+        self._statements.clear()
+        self._unprepared_keys.clear()
+
+    def callproc(self, c, name, args):
+        try:
+            self._execute(c, name, args)
+        except PgError as e:
+            # The server forgets prepared statements when the session
+            # gets reset, and refuses to execute them when a
+            # procedure's result type has changed. Outside of a
+            # transaction, the call can be safely retried.
+            if getattr(e, 'pgcode', '') not in (INVALID_SQL_STATEMENT_NAME,
+                                                FEATURE_NOT_SUPPORTED):
+                raise
+            self.clear()
+            if c.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                raise
+            c.execute('DEALLOCATE ALL')
+            self._execute(c, name, args)
+
+    def _execute(self, c, name, args):
+        key = (name, len(args))
+        statements = self._statements
+        statement = statements.pop(key, None)
+        if statement is None:
+            if key in self._unprepared_keys or not self._is_unambiguous(c, name, len(args)):
+                self._unprepared_keys.add(key)
+                c.callproc(name, args)
+                return
+            if len(statements) >= self.size:
+                c.execute('DEALLOCATE %s' % statements.popitem(last=False)[1])
+            self._counter += 1
+            statement = 'curiousorm_%i' % self._counter
+            c.execute('PREPARE %s AS SELECT * FROM %s(%s)' % (
+                statement, name, ','.join(['$%i' % (i + 1) for i in range(len(args))])))
+        statements[key] = statement
+        if args:
+            c.execute('EXECUTE %s (%s)' % (statement, ','.join(len(args) * ['%s'])), args)
+        else:
+            c.execute('EXECUTE %s' % statement)
+
+    @staticmethod
+    def _is_unambiguous(c, name, nargs):
+        # Returns whether exactly one visible procedure has the given
+        # name and number of arguments.
+        c.execute(
+            'SELECT COUNT(*) FROM pg_proc '
+            'WHERE proname=%s AND pronargs=%s AND pg_function_is_visible(oid)',
+            (name, nargs))
+        return c.fetchall()[0][0] == 1
+
+
+class Row(tuple):
+    """A read-only row that can be indexed by column names too.
+
+    Rows support tuple unpacking, "row[0]", "row['name']",
+    "keys()", "values()", "items()", "get()" and "in", like
+    psycopg2's "DictRow" does. Columns can be accessed as attributes
+    as well, unless their names clash with the methods above. Each
+    distinct list of column names gets its own "Row" sub-class,
+    which holds the column-index map.
+
+    >>> row = _get_row_class(['id', 'count', 'index'])((1, 20, 300))
+    >>> row['id'], row.count, row.index
+    (1, 20, 300)
+    >>> id, count, index = row
+    >>> row.get('index'), row.get('name'), row.get(5, 0), row.get(None)
+    (300, None, 0, None)
+    >>> 'count' in row, 20 in row
+    (True, False)
+    >>> row.keys()
+    ['id', 'count', 'index']
+    >>> row.items()
+    [('id', 1), ('count', 20), ('index', 300)]
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(row))
+    Row(id=1, count=20, index=300)
+    """
+
+    __slots__ = ()
+    _names = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __reduce__(self):
+        return _create_row, (self._names, tuple(self))
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._names, self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError, TypeError):
+            return default
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % i for i in self.items())
+
+
+_row_classes = {}
+
+# Column names that can not be accessed as attributes. (The names of
+# tuple's "count" and "index" methods can.)
+_ROW_ATTRIBUTES = frozenset(dir(Row)) - frozenset(['count', 'index'])
+
+
+def _get_column_property(i):
+    return property(lambda self: tuple.__getitem__(self, i))
+
+
+def _get_row_class(names):
+    names = tuple(names)
+    try:
+        return _row_classes[names]
+    except KeyError:
+        attrs = {'__slots__': (), '_names': names, '_index': {}}
+        for i, name in enumerate(names):
+            attrs['_index'][name] = i
+            if name not in _ROW_ATTRIBUTES:
+                attrs[name] = _get_column_property(i)
+        cls = _row_classes[names] = type('Row', (Row,), attrs)
+        return cls
+
+
+def _create_row(names, values):
+    return _get_row_class(names)(values)
+
+
+class RowCursor(psycopg2.extensions.cursor):
+    """A cursor that returns "Row" instances."""
+
+    def _get_row_class(self):
+        return _get_row_class(column[0] for column in self.description)
+
+    def fetchone(self):
+        row = super(RowCursor, self).fetchone()
+        return row if row is None else self._get_row_class()(row)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = super(RowCursor, self).fetchmany(size)
+        return map(self._get_row_class(), rows) if rows else rows
+
+    def fetchall(self):
+        rows = super(RowCursor, self).fetchall()
+        return map(self._get_row_class(), rows) if rows else rows
+
+    def __iter__(self):
+        cls = None
+        for row in super(RowCursor, self).__iter__():
+            if cls is None:
+                cls = self._get_row_class()
+            yield cls(row)
+
+
+def _get_cursor_factory(dictrows):
+    if dictrows == LIGHTROWS:
+        return RowCursor
+    return DictCursor if dictrows else NamedTupleCursor
+
+
 class RowUpdater(collections.MutableMapping):
     """A mutable dict-like object that knows which row it comes from."""
 
@@ -184,32 +386,138 @@ class RowUpdater(collections.MutableMapping):
         self._database.execute(query, values)
 
 
+class Batch(object):
+    """Collects several queries, and executes them together.
+
+    Stored procedures are called and tables are selected like on the
+    mapper that created the batch (except that "__return" is not
+    supported), but nothing is sent to the server before "execute" is
+    called. Then all the queries are executed one after another, on
+    the same connection, and a list of their results is returned in
+    order:
+
+      batch = db.batch()
+      batch.get_deposit_list(trader_id, partner_id)
+      batch.get_shopping_item_list(trader_id, partner_id)
+      deposits, shopping_items = batch.execute()
+
+    The results are exactly the same as those of the separate calls.
+    (psycopg2 returns only the last result of a multi-statement
+    query, so the queries are not sent in a single request.)
+    """
+
+    def __init__(self, execute, callproc):
+        self._execute = execute
+        self._callproc = callproc
+        self._actions = []
+
+    def __len__(self):
+        return len(self._actions)
+
+    def callproc(self, name, args=[], onerow=False):
+        self._actions.append((lambda c: self._callproc(c, name, args), onerow))
+
+    def select(self, name, onerow=False, **kwargs):
+        assert '__return' not in kwargs
+        query, values = _compose_select(kwargs, table=name)
+        self._actions.append((lambda c: c.execute(query, values), onerow))
+
+    def __getattr__(self, full_name):
+        if full_name.startswith('__'):
+            raise AttributeError(full_name)
+        name, onerow = full_name, True
+        if name.endswith('_list'):
+            name, onerow = name[:-len('_list')], False
+        if name.startswith('select_'):
+            return lambda **kwargs: self.select(name[len('select_'):], onerow, **kwargs)
+        if name.startswith('callproc_'):
+            name = name[len('callproc_'):]
+        return lambda *args: self.callproc(name, args, onerow)
+
+    def execute(self):
+        actions, self._actions = self._actions, []
+        return self._execute(actions) if actions else []
+
+
 class AbstractMapper(object):
-    """Implements convenient methods for accessing databases."""
+    """Implements convenient methods for accessing databases.
+
+    Methods like "select_X_list" are created on demand. When their
+    names have one of the known prefixes or suffixes, they get
+    installed on the class, so that repeated calls do not go through
+    "__getattr__" again. Other names are called as stored procedures,
+    and are not cached, because any attribute probe would match
+    them. Sub-classes may call "declare" to install methods in
+    advance, including plain stored procedures.
+    """
 
     __prefixes = ['select_', 'insert_', 'callproc_']
     __suffixes = ['_list', '_for_share', '_for_update']
+    __prefix_tuple = tuple(__prefixes)
+    __suffix_tuple = tuple(__suffixes)
 
     def execute(self, query, values=[], onerow=False):
-        return self.__execute(lambda c: c.execute(query, values), onerow)
+        return self.__execute([(lambda c: c.execute(query, values), onerow)])[0]
 
     def callproc(self, name, args=[], onerow=False):
-        return self.__execute(lambda c: c.callproc(name, args), onerow)
+        return self.__execute([(lambda c: self.__callproc(c, name, args), onerow)])[0]
 
-    def __getattr__(self, full_name):
-        name, prefix, suffix = self.__decompose_name(full_name)
-        method = self.__getattribute__('_%sX%s' % (prefix, suffix))
-        return method(name)
+    def batch(self):
+        """Returns a new "Batch" of queries on this mapper."""
+
+        return Batch(self.__execute, self.__callproc)
+
+    def copy_expert(self, sql, file, size=8192):
+        o = self._acquire_connection()
+        try:
+            c = self._create_cursor(o)
+            c.copy_expert(sql, file, size)
+            c.close()
+        finally:
+            self._release_connection(o)
 
-    def __decompose_name(self, name):
-        for p in self.__prefixes:
+    def __callproc(self, c, name, args):
+        statement_cache = self._get_statement_cache(c.connection)
+        if statement_cache is None:
+            c.callproc(name, args)
+        else:
+            statement_cache.callproc(c, name, args)
+
+    def _get_statement_cache(self, connection):
+        return None
+
+    def __getattr__(self, full_name):
+        if (full_name.startswith('__') or not (
+                full_name.startswith(AbstractMapper.__prefix_tuple) or
+                full_name.endswith(AbstractMapper.__suffix_tuple))):
+            return partial(self._X, full_name)
+        type(self).declare(full_name)
+        return self.__getattribute__(full_name)
+
+    @classmethod
+    def declare(cls, *full_names):
+        """Installs the given methods for all instances of the class."""
+
+        def create_method(implementation, name):
+            def method(self, *args, **kwargs):
+                return implementation(self, name, *args, **kwargs)
+            return method
+
+        for full_name in full_names:
+            name, prefix, suffix = AbstractMapper.__decompose_name(full_name)
+            implementation = getattr(cls, '_%sX%s' % (prefix, suffix))
+            setattr(cls, full_name, create_method(implementation, name))
+
+    @staticmethod
+    def __decompose_name(name):
+        for p in AbstractMapper.__prefixes:
             if name.startswith(p):
                 prefix = p
                 name = name[len(prefix):]
                 break
         else:
             prefix = ''
-        for s in self.__suffixes:
+        for s in AbstractMapper.__suffixes:
             if name.endswith(s):
                 suffix = s
                 name = name[:-len(suffix)]
@@ -218,64 +526,62 @@ class AbstractMapper(object):
             suffix = ''
         return name, prefix, suffix
 
-    def __execute(self, perform_cursor_action, onerow):
+    def __execute(self, actions):
+        # Performs a list of "(perform_cursor_action, onerow)" pairs on
+        # the same connection, and returns a list of their results.
+        results = []
         o = self._acquire_connection()
         try:
-            c = self._create_cursor(o)
-            perform_cursor_action(c)
-            try:
-                rows = c.fetchall()
-            except psycopg2.Error:
-                rows = []
-            c.close()
+            for perform_cursor_action, onerow in actions:
+                c = self._create_cursor(o)
+                perform_cursor_action(c)
+                try:
+                    rows = c.fetchall()
+                except psycopg2.Error:
+                    rows = []
+                c.close()
+                results.append(_pick_one_row_at_most(rows) if onerow else rows)
         finally:
             self._release_connection(o)
-        return _pick_one_row_at_most(rows) if onerow else rows
+        return results
 
-    def _X(self, name):
-        return lambda *args : self.callproc(name, args, onerow=True)        
+    def _X(self, name, *args):
+        return self.callproc(name, args, onerow=True)
 
-    def _X_list(self, name):
-        return lambda *args : self.callproc(name, args)
+    def _X_list(self, name, *args):
+        return self.callproc(name, args)
 
     _callproc_X = _X
 
     _callproc_X_list = _X_list
         
-    def _select_X(self, name):
-        def f(**kwargs):
-            query, values = _compose_select(kwargs, table=name)
+    def _select_X(self, table, **kwargs):
+        query, values = _compose_select(kwargs, table=table)
+        return self.execute(query, values, onerow=True)
+
+    def _select_X_list(self, table, **kwargs):
+        query, values = _compose_select(kwargs, table=table)
+        return self.execute(query, values)
+
+    def _select_X_for_share(self, table, **kwargs):
+        query, values = _compose_select(kwargs, table=table)
+        return self.execute(query + ' FOR SHARE', values, onerow=True)
+
+    def _insert_X(self, table, *args, **kwargs):
+        if kwargs:
+            query, values = _compose_insert(kwargs, table=table)
             return self.execute(query, values, onerow=True)
-        return f
-
-    def _select_X_list(self, name):
-        def f(**kwargs):
-            query, values = _compose_select(kwargs, table=name)
-            return self.execute(query, values)
-        return f
-
-    def _select_X_for_share(self, name):
-        def f(**kwargs):
-            query, values = _compose_select(kwargs, table=name)
-            return self.execute(query + ' FOR SHARE', values, onerow=True)
-        return f
-
-    def _insert_X(self, name):
-        def f(*args, **kwargs):
-            if kwargs:
-                query, values = _compose_insert(kwargs, table=name)
-                return self.execute(query, values, onerow=True)
-            else:
-                # Stored procedures named 'insert_X' are allowed
-                # because those can be very convenient sometimes.
-                return self.callproc('insert_' + name, args, onerow=True)
-        return f
+        else:
+            # Stored procedures named 'insert_X' are allowed
+            # because those can be very convenient sometimes.
+            return self.callproc('insert_' + table, args, onerow=True)
 
 
 class TransactionMapper(AbstractMapper):
-    def __init__(self, connection, dictrows):
+    def __init__(self, connection, dictrows, statement_cache=None):
         self.__connection = connection
         self.__dictrows = dictrows
+        self.__statement_cache = statement_cache
 
     def _acquire_connection(self):
         return self.__connection
@@ -283,22 +589,23 @@ class TransactionMapper(AbstractMapper):
     def _release_connection(self, connection):
         assert connection is self.__connection
 
+    def _get_statement_cache(self, connection):
+        return self.__statement_cache
+
     def _create_cursor(self, connection):
         return connection.cursor(
-            cursor_factory=DictCursor if self.__dictrows else NamedTupleCursor)
-
-    def _select_X_for_update(self, name):
-        def f(**kwargs):
-            query, values = _compose_select(kwargs, table=name)
-            rows = self.execute(query + ' FOR UPDATE', values)
-            if len(rows) == 1:
-                row = dict(rows[0]) if self.__dictrows else rows[0]._asdict()
-                return RowUpdater(self, name, kwargs, row)
-            elif len(rows) == 0:
-                return None
-            else:
-                raise MultipleRowsError()
-        return f
+            cursor_factory=_get_cursor_factory(self.__dictrows))
+
+    def _select_X_for_update(self, table, **kwargs):
+        query, values = _compose_select(kwargs, table=table)
+        rows = self.execute(query + ' FOR UPDATE', values)
+        if len(rows) == 1:
+            row = dict(rows[0]) if self.__dictrows else rows[0]._asdict()
+            return RowUpdater(self, table, kwargs, row)
+        elif len(rows) == 0:
+            return None
+        else:
+            raise MultipleRowsError()
 
     def set_asynchronous_commit(self):
         self.execute('SET LOCAL synchronous_commit TO OFF')
@@ -309,7 +616,8 @@ class TransactionMapper(AbstractMapper):
 #############################################################
 
 __all__ = ['PgError', 'PgIntegrityError', 'Binary', 'Connection', 
-           'Database', 'Cursor', 'retry_on_deadlock']
+           'Database', 'PooledDatabase', 'PoolTimeoutError', 'Cursor',
+           'Row', 'LIGHTROWS', 'Batch', 'retry_on_deadlock']
 
 
 __doc__ =  """A very simple object-relational mapper for PostgreSQL.
@@ -371,8 +679,29 @@ __doc__ =  """A very simple object-relational mapper for PostgreSQL.
     u'curiousorm_test'
     >>> db.current_database_list()  # the same, but returns a list instead
     [Record(current_database=u'curiousorm_test')]
-
-    This ORM consists of less than 20KB of very clean, thread-safe
+    >>> batch = db.batch()  # executes several queries together
+    >>> batch.select_account_list()
+    >>> batch.current_database()
+    >>> batch.execute() == [db.select_account_list(), db.current_database()]
+    True
+
+    "Database" instances share a single connection between all
+    threads. Multi-threaded servers may use "PooledDatabase" instead,
+    which has the same interface, but checks out a separate connection
+    for each call or transaction.
+
+    If "statement_cache_size" is given to the constructor, stored
+    procedure calls are prepared once per connection, and executed
+    after that, so that the server does not plan them every time.
+    Several calls can also be executed together, on the same
+    connection, with "batch()".
+
+    Rows are named tuples by default. With "dictrows=True" they are
+    psycopg2's "DictRow" lists, and with "dictrows=LIGHTROWS" they are
+    "Row" tuples, which can also be indexed by column names, but are
+    much cheaper to create.
+
+    This ORM consists of less than 45KB of very clean, thread-safe
     code, so that it can be reviewed and understood with minimum
     effort. In fact, reading and understanding the code is the
     recommended way of mastering it.
@@ -385,14 +714,17 @@ PgIntegrityError = psycopg2.IntegrityError
 
 Binary = psycopg2.Binary
 
+LIGHTROWS = 'lightrows'
+
 
 class Connection(AbstractMapper):
     """A separate database connection, enriched with useful methods."""
 
-    def __init__(self, dsn, dictrows=False):
+    def __init__(self, dsn, dictrows=False, statement_cache_size=0):
         self.__connection = _connect(dsn, autocommit=True)
         self.__connection_lock = threading.RLock()
         self.__dictrows = dictrows
+        self.__statement_cache = _StatementCache(statement_cache_size) if statement_cache_size else None
         self.__inside_transaction = False
 
     def __enter__(self):
@@ -409,23 +741,24 @@ class Connection(AbstractMapper):
         assert connection is self.__connection
         self.__connection_lock.release()
 
+    def _get_statement_cache(self, connection):
+        return self.__statement_cache
+
     def _create_cursor(self, connection):
         return connection.cursor(
-            cursor_factory=DictCursor if self.__dictrows else NamedTupleCursor)
-
-    def _select_X_for_update(self, name):
-        def f(**kwargs):
-            query, values = _compose_select(kwargs, table=name)
-            query += ' FOR UPDATE' if self.__inside_transaction else ''
-            rows = self.execute(query, values)
-            if len(rows) == 1:
-                row = dict(rows[0]) if self.__dictrows else rows[0]._asdict()
-                return RowUpdater(self, name, kwargs, row)
-            elif len(rows) == 0:
-                return None
-            else:
-                raise MultipleRowsError()
-        return f
+            cursor_factory=_get_cursor_factory(self.__dictrows))
+
+    def _select_X_for_update(self, table, **kwargs):
+        query, values = _compose_select(kwargs, table=table)
+        query += ' FOR UPDATE' if self.__inside_transaction else ''
+        rows = self.execute(query, values)
+        if len(rows) == 1:
+            row = dict(rows[0]) if self.__dictrows else rows[0]._asdict()
+            return RowUpdater(self, table, kwargs, row)
+        elif len(rows) == 0:
+            return None
+        else:
+            raise MultipleRowsError()
 
     def close(self):
         with self.__connection_lock:
@@ -436,7 +769,7 @@ class Connection(AbstractMapper):
         self.__connection_lock.acquire()
         assert not self.__inside_transaction, 'transactions can not be nested'
         self.__inside_transaction = True
-        trx = TransactionMapper(self.__connection, self.__dictrows)
+        trx = TransactionMapper(self.__connection, self.__dictrows, self.__statement_cache)
         try:
             trx.execute('BEGIN')
             yield trx
@@ -451,35 +784,289 @@ class Connection(AbstractMapper):
 
 
 class Database(Connection):
-    """A shared database connection, enriched with useful methods."""
+    """A shared database connection, enriched with useful methods.
+
+    There is only one instance per (class, dsn, dictrows,
+    statement_cache_size).
+    """
 
     __instances_lock = threading.Lock()
     __is_frozen = False
 
-    def __new__(cls, dsn, dictrows=False):
+    def __new__(cls, dsn, dictrows=False, statement_cache_size=0):
         with Database.__instances_lock:
             attr_name = '_%s__instances' % cls.__name__
             if not hasattr(cls, attr_name):
                 setattr(cls, attr_name, {})
             instances = getattr(cls, attr_name)
-            if (dsn, dictrows) not in instances:
+            key = (dsn, dictrows, statement_cache_size)
+            if key not in instances:
                 instance = object.__new__(cls)
-                Connection.__init__(instance, dsn, dictrows)
+                Connection.__init__(instance, dsn, dictrows, statement_cache_size)
                 instance._Database__is_frozen = True
-                instances[(dsn, dictrows)] = instance
-        return instances[(dsn, dictrows)]
+                instances[key] = instance
+        return instances[key]
+
+    def __init__(self, dsn, dictrows=False, statement_cache_size=0):
+        pass
+
+    def __setattr__(self, key, value):
+        if self.__is_frozen and key not in self.__dict__:
+            raise TypeError('%r is a frozen instance' % self)
+        object.__setattr__(self, key, value)
+
+    def close(self):
+        pass
+
+
+class _PooledConnection(object):
+    __slots__ = ['connection', 'statement_cache', 'created_ts', 'last_used_ts']
+
+    def __init__(self, connection, statement_cache_size=0):
+        self.connection = connection
+        self.statement_cache = _StatementCache(statement_cache_size) if statement_cache_size else None
+        self.created_ts = self.last_used_ts = time.time()
+
+
+class _PoolThreadState(threading.local):
+    def __init__(self):
+        self.transaction = None
+
+
+class PooledDatabase(AbstractMapper):
+    """A shared pool of database connections, enriched with useful methods.
+
+    Unlike "Database", which serializes all threads on a single
+    connection, every call checks out a connection from the pool, and
+    returns it when done. Within a "Transaction", the calls made by
+    the same thread use the transaction's connection. The parameters
+    are:
+
+    min_size -- the number of connections opened in advance;
+    max_size -- the maximal number of open connections;
+    timeout -- seconds to wait for a connection before giving up with
+               "PoolTimeoutError";
+    max_lifetime -- seconds after which a connection gets reopened;
+    health_check_interval -- connections idle for more seconds get
+                             checked before being used;
+    statement_cache_size -- see "_StatementCache" (0 disables it).
+
+    There is only one instance per (class, dsn, dictrows,
+    statement_cache_size). The other pool parameters of the first
+    instantiation are used.
+    """
+
+    __instances_lock = threading.Lock()
+    __is_frozen = False
 
-    def __init__(self, dsn, dictrows=False):
+    def __new__(cls, dsn, dictrows=False, **pool_params):
+        with PooledDatabase.__instances_lock:
+            attr_name = '_%s__instances' % cls.__name__
+            if not hasattr(cls, attr_name):
+                setattr(cls, attr_name, {})
+            instances = getattr(cls, attr_name)
+            key = (dsn, dictrows, pool_params.get('statement_cache_size', 0))
+            if key not in instances:
+                instance = object.__new__(cls)
+                instance.__init_pool(dsn, dictrows, **pool_params)
+                instance._PooledDatabase__is_frozen = True
+                instances[key] = instance
+        return instances[key]
+
+    def __init__(self, dsn, dictrows=False, **pool_params):
         pass
 
+    def __init_pool(self, dsn, dictrows, min_size=1, max_size=10, timeout=30.0,
+                    max_lifetime=3600.0, health_check_interval=60.0,
+                    statement_cache_size=0):
+        assert 0 <= min_size <= max_size and max_size > 0
+        self.__dsn = dsn
+        self.__statement_cache_size = statement_cache_size
+        self.__dictrows = dictrows
+        self.__max_size = max_size
+        self.__timeout = timeout
+        self.__max_lifetime = max_lifetime
+        self.__health_check_interval = health_check_interval
+        self.__condition = threading.Condition(threading.Lock())
+        self.__idle = collections.deque()
+        self.__checked_out = {}
+        self.__size = 0
+        self.__thread_state = _PoolThreadState()
+        self.__stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'timeouts': 0,
+            'connects': 0,
+            'discards': 0,
+            }
+        for i in range(min_size):
+            self.__idle.append(self.__connect())
+            self.__size += 1
+
     def __setattr__(self, key, value):
         if self.__is_frozen and key not in self.__dict__:
             raise TypeError('%r is a frozen instance' % self)
         object.__setattr__(self, key, value)
 
+    def __connect(self):
+        pooled = _PooledConnection(
+            _connect(self.__dsn, autocommit=True), self.__statement_cache_size)
+        with self.__condition:
+            self.__stats['connects'] += 1
+        return pooled
+
+    def __discard(self, pooled):
+        with self.__condition:
+            self.__stats['discards'] += 1
+        try:
+            pooled.connection.close()
+        except PgError:
+            pass
+
+    def __is_healthy(self, pooled):
+        now = time.time()
+        o = pooled.connection
+        if o.closed or now - pooled.created_ts > self.__max_lifetime:
+            return False
+        if now - pooled.last_used_ts > self.__health_check_interval:
+            try:
+                c = o.cursor()
+                c.execute('SELECT 1')
+                c.close()
+            except PgError:
+                return False
+        return True
+
+    def __checkout(self):
+        started_at = time.time()
+        deadline = started_at + self.__timeout
+        has_waited = False
+        with self.__condition:
+            while True:
+                if self.__idle:
+                    # The most recently used connection is taken, so
+                    # that surplus connections stay idle and age.
+                    pooled = self.__idle.pop()
+                    break
+                if self.__size < self.__max_size:
+                    pooled = None
+                    self.__size += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.__stats['timeouts'] += 1
+                    raise PoolTimeoutError('no connection available in %s seconds' % self.__timeout)
+                self.__condition.wait(remaining)
+                has_waited = True
+            stats = self.__stats
+            wait_seconds = time.time() - started_at
+            stats['checkouts'] += 1
+            stats['waits'] += has_waited
+            stats['wait_seconds'] += wait_seconds
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], wait_seconds)
+
+        # Connecting and health checks are done without holding the lock.
+        try:
+            if pooled is not None and not self.__is_healthy(pooled):
+                self.__discard(pooled)
+                pooled = None
+            if pooled is None:
+                pooled = self.__connect()
+        except:
+            with self.__condition:
+                self.__size -= 1
+                self.__condition.notify()
+            raise
+        with self.__condition:
+            self.__checked_out[pooled.connection] = pooled
+        return pooled
+
+    def __checkin(self, pooled):
+        o = pooled.connection
+        is_reusable = not o.closed and o.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        if not is_reusable:
+            self.__discard(pooled)
+        with self.__condition:
+            del self.__checked_out[o]
+            if is_reusable:
+                pooled.last_used_ts = time.time()
+                self.__idle.append(pooled)
+            else:
+                self.__size -= 1
+            self.__condition.notify()
+
+    def _acquire_connection(self):
+        transaction = self.__thread_state.transaction
+        if transaction is not None:
+            return transaction.connection
+        return self.__checkout().connection
+
+    def _release_connection(self, connection):
+        transaction = self.__thread_state.transaction
+        if transaction is not None:
+            assert connection is transaction.connection
+            return
+        with self.__condition:
+            pooled = self.__checked_out[connection]
+        self.__checkin(pooled)
+
+    def _get_statement_cache(self, connection):
+        transaction = self.__thread_state.transaction
+        if transaction is not None:
+            return transaction.statement_cache
+        with self.__condition:
+            return self.__checked_out[connection].statement_cache
+
+    def _create_cursor(self, connection):
+        return connection.cursor(
+            cursor_factory=_get_cursor_factory(self.__dictrows))
+
+    def _select_X_for_update(self, table, **kwargs):
+        query, values = _compose_select(kwargs, table=table)
+        query += ' FOR UPDATE' if self.__thread_state.transaction else ''
+        rows = self.execute(query, values)
+        if len(rows) == 1:
+            row = dict(rows[0]) if self.__dictrows else rows[0]._asdict()
+            return RowUpdater(self, table, kwargs, row)
+        elif len(rows) == 0:
+            return None
+        else:
+            raise MultipleRowsError()
+
+    def get_stats(self):
+        """Returns the pool statistics, which may help sizing it."""
+
+        with self.__condition:
+            stats = dict(self.__stats)
+            stats['size'] = self.__size
+            stats['idle'] = len(self.__idle)
+            stats['max_size'] = self.__max_size
+        return stats
+
     def close(self):
         pass
 
+    @contextmanager
+    def Transaction(self):
+        thread_state = self.__thread_state
+        assert thread_state.transaction is None, 'transactions can not be nested'
+        pooled = self.__checkout()
+        thread_state.transaction = pooled
+        trx = TransactionMapper(pooled.connection, self.__dictrows, pooled.statement_cache)
+        try:
+            trx.execute('BEGIN')
+            yield trx
+        except:
+            trx.execute('ROLLBACK')
+            raise
+        else:
+            trx.execute('COMMIT')
+        finally:
+            thread_state.transaction = None
+            self.__checkin(pooled)
+
 
 class Cursor:
     """A server-side cursor iterator."""
@@ -522,7 +1109,7 @@ class Cursor:
     def _create_named_cursor(self):
         c = self._connection.cursor(
             'curiousorm_cursor', 
-            cursor_factory=DictCursor if self._dictrows else NamedTupleCursor
+            cursor_factory=_get_cursor_factory(self._dictrows)
             )
         c.arraysize = self._buffer_size
         c.execute(self._query, self._query_params)
@@ -28,208 +28,540 @@
 ## graphs.
 ##
 from __future__ import division
+from array import array
+from collections import deque
+import os, multiprocessing, mmap, tempfile, ctypes, warnings
 
 
-def _int2str(i):
-    b_list = (
-        i & 0x000000ff, 
-        (i & 0x0000ff00) >> 8, 
-        (i & 0x00ff0000) >> 16, 
-        (i & 0x7f000000) >> 24,
-        )
-    return ''.join([chr(b) for b in b_list])
+# Bond amounts are integers. On platforms where the C "long" type is
+# only 32 bits wide we use doubles, which can still represent exactly
+# all integers up to 2**53.
+AMOUNT_TYPECODE = 'l' if array('l').itemsize >= 8 else 'd'
 
+# Markets with more bonds than this are matched greedily by the
+# "CirculationBondMatcher", because the maximum circulation would take
+# too long to compute.
+CIRCULATION_MAX_BOND_COUNT = 200000
 
-def _str2int(s):
-    b0, b1, b2, b3 = [ord(c) for c in s]
-    return b0 | (b1 << 8) | (b2 << 16) | (b3 << 24)
 
+def _load_kernel():
+    try:
+        from cmbarter.modules._matcher_kernel import ffi, lib
+    except ImportError:
+        # This module is being run as a script, or imported from
+        # outside the "cmbarter" package. The kernel must be loaded
+        # under the name it has been built with.
+        import imp
+        f, pathname, description = imp.find_module(
+            '_matcher_kernel', [os.path.dirname(os.path.abspath(__file__))])
+        try:
+            kernel = imp.load_module(
+                'cmbarter.modules._matcher_kernel', f, pathname, description)
+        finally:
+            if f:
+                f.close()
+        ffi, lib = kernel.ffi, kernel.lib
+    return ffi, lib
+
+
+# The cycle search is performed by a native kernel, if it has been
+# built (see "matcher_kernel_build.py"), and amounts are C "long"s.
+try:
+    _ffi, _lib = _load_kernel()
+except ImportError:
+    _ffi = _lib = None
+if AMOUNT_TYPECODE != 'l':
+    _ffi = _lib = None
+
+
+_CTYPES = {'i': ctypes.c_int, 'l': ctypes.c_long, 'd': ctypes.c_double}
+
+
+class _MmapArrays:
+    """
+    Creates arrays kept in memory-mapped temporary files.
+
+    The OS can page the cold parts of such arrays out of RAM. The
+    files are created in the given directory, and are deleted
+    immediately, so that they disappear when the arrays are freed:
+    >>> arrays = _MmapArrays(tempfile.gettempdir())
+    >>> a = arrays.zeros('i', 3)
+    >>> a[1] = 5
+    >>> list(a)
+    [0, 5, 0]
+
+    Append-only arrays are spilled to their file in chunks, and get
+    mapped when finished:
+    >>> a = arrays.appendable('l')
+    >>> for i in xrange(3): a.append(i)
+    >>> list(a.finish())
+    [0, 1, 2]
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def map_file(self, f, typecode, length):
+        # The mapping stays alive as long as the returned array does.
+        if length == 0:
+            return array(typecode)
+        ctype = _CTYPES[typecode]
+        f.flush()
+        m = mmap.mmap(f.fileno(), length * ctypes.sizeof(ctype))
+        return (ctype * length).from_buffer(m)
+
+    def zeros(self, typecode, length):
+        with tempfile.TemporaryFile(dir=self.dirname) as f:
+            f.truncate(length * ctypes.sizeof(_CTYPES[typecode]))
+            return self.map_file(f, typecode, length)
+
+    def appendable(self, typecode):
+        return _SpilledArray(self, typecode)
+
+
+class _SpilledArray:
+    """An append-only array that spills its items to a temporary file."""
+
+    CHUNK_LENGTH = 1 << 16
+
+    def __init__(self, arrays, typecode):
+        self._arrays = arrays
+        self._typecode = typecode
+        self._file = tempfile.TemporaryFile(dir=arrays.dirname)
+        self._chunk = array(typecode)
+        self._length = 0
+
+    def __len__(self):
+        return self._length + len(self._chunk)
+
+    def append(self, x):
+        chunk = self._chunk
+        chunk.append(x)
+        if len(chunk) >= self.CHUNK_LENGTH:
+            self._spill()
+
+    def _spill(self):
+        self._chunk.tofile(self._file)
+        self._length += len(self._chunk)
+        self._chunk = array(self._typecode)
 
-def pair2str(a, b):
+    def finish(self):
+        self._spill()
+        with self._file as f:
+            return self._arrays.map_file(f, self._typecode, self._length)
+
+
+def _zeros(arrays, typecode, length):
+    if arrays is None:
+        return array(typecode, [0]) * length
+    return arrays.zeros(typecode, length)
+
+
+def _truncate(a, length):
+    # Memory-mapped arrays can not be truncated. Their unused tails
+    # do not take RAM, though.
+    if isinstance(a, array):
+        del a[length:]
+
+
+def pair2int(a, b):
     """
-    Transforms two positive 32-bit integers to interned string.
+    Packs two positive 32-bit integers into a single integer.
 
-    >>> s1 = pair2str(1, 234567)
-    >>> s2 = pair2str(1, 234567)
-    >>> s1 is s1
+    >>> pair2int(1, 234567) == pair2int(1, 234567)
     True
+    >>> pair2int(1, 234567) == pair2int(234567, 1)
+    False
     """
     assert a > 0 and b >= 0
-    return intern(_int2str(a) + _int2str(b))
+    return (a << 32) | b
 
 
-def str2pair(s):
+def int2pair(i):
     """
-    Restores the integers (a, b) if given the string produced by pair2str(a, b).
+    Restores the integers (a, b) if given the integer produced by pair2int(a, b).
 
     Example:
-    >>> str2pair(pair2str(123, 456))
+    >>> int2pair(pair2int(123, 456))
     (123, 456)
     """
-    return _str2int(s[0:4]), _str2int(s[4:8])
-
-
-ROOT_VERTEX = intern(8 * chr(0))
+    return int(i >> 32), int(i & 0xffffffff)
 
 
 class Digraph:
     """
-    A directed graph.
+    A directed graph with vertices 0, 1, ... (vertex_count - 1).
 
-    Create a graph:
-    >>> graph = Digraph()
+    The arcs are kept in compressed sparse row form: the heads of the
+    arcs going out from vertex "u" are stored in "_heads" between
+    positions "_offsets[u]" and "_ends[u]". Arcs' amounts are stored
+    at the same positions in "_amounts". Removed arcs are swapped
+    with the last arc of their vertex, and are kept between
+    "_ends[u]" and "_offsets[u+1]". Also, every vertex has a cursor
+    -- the arcs before "_cursors[u]" have already been scanned by the
+    cycle finder.
 
-    Add some arcs:
-    >>> graph.add_arc(1, 2)
-    >>> graph.add_arc(1, 3)
+    Arcs' arrays may have unused items after position
+    "_offsets[vertex_count]". This happens when the arrays are
+    memory-mapped (see "_MmapArrays"), which is requested by passing
+    the "arrays" argument.
 
-    Display all outgoing arcs from a given vertex:
-    >>> graph._vmap[1]
-    [2, 3]
+    Create a graph from parallel sequences of tails, heads, and
+    amounts. If the same arc is given more than once, the last one
+    wins. Arcs having amounts less than "min_amount" are dropped:
+    >>> graph = Digraph(4, [1, 1, 2, 1, 3], [2, 3, 0, 2, 1], [5, 6, 7, 8, 0])
+    >>> list(graph._offsets)
+    [0, 0, 2, 3, 3]
+    >>> list(graph._heads)
+    [3, 2, 0]
+    >>> list(graph._amounts)
+    [6, 8, 7]
 
     Remove some arcs:
-    >>> graph.remove_arc(1, 2)
-    >>> graph._vmap[1]
-    [None, 3]
-    >>> graph.has_arc(3, 1)
-    False
-    >>> graph.has_arc(1, 3)
-    True
     >>> graph.remove_arc(1, 3)
-    >>> graph._vmap[1]
-    [None, None]
-
-    Remove all outgoing arcs from a given vertex:
-    >>> graph._sink_vertex(1)
-    >>> 1 in graph._vmap
+    >>> list(graph._heads)
+    [2, 3, 0]
+    >>> list(graph._ends)
+    [0, 1, 3, 3]
+    >>> graph.has_arc(1, 3)
     False
+    >>> graph.has_arc(1, 2)
+    True
     """
-    
-    def __init__(self):
-        self._vmap = {ROOT_VERTEX: []}
 
-    def has_arc(self, u, v):
-        assert u != ROOT_VERTEX
-        assert v is not None
-        if u in self._vmap:
-            if v in self._vmap[u]:
-                return True
-        return False
+    def __init__(self, vertex_count, tails, heads, amounts, min_amount=1, arrays=None):
+        assert len(tails) == len(heads) == len(amounts)
+        self.vertex_count = vertex_count
 
-    def add_arc(self, u, v):
-        assert v is not None
-        assert v != ROOT_VERTEX
-        if u in self._vmap:
-            self._vmap[u].append(v)
-        else:
-            self._vmap[u] = [v]
-            self._vmap[ROOT_VERTEX].append(u)
+        # Sort the arcs by their tails (a stable counting sort).
+        arc_count = len(tails)
+        starts = array('i', [0]) * (vertex_count + 1)
+        for u in tails:
+            starts[u + 1] += 1
+        for u in xrange(vertex_count):
+            starts[u + 1] += starts[u]
+        order = _zeros(arrays, 'i', arc_count)
+        for i in xrange(arc_count):
+            u = tails[i]
+            order[starts[u]] = i
+            starts[u] += 1
 
-    def remove_arc(self, u, v):
-        assert u != ROOT_VERTEX
-        try:
-            vlist = self._vmap[u]
-            vlist[vlist.index(v)] = None
-        except (KeyError, ValueError):
-            pass
+        # After the sort "starts[u]" points to the end of the arcs of
+        # "u". Now we copy the arcs, dropping the void ones and the
+        # overwritten duplicates.
+        offsets = self._offsets = array('i', [0]) * (vertex_count + 1)
+        graph_heads = self._heads = _zeros(arrays, 'i', arc_count)
+        graph_amounts = self._amounts = _zeros(arrays, AMOUNT_TYPECODE, arc_count)
+        kept_count = 0
+        begin = 0
+        for u in xrange(vertex_count):
+            end = starts[u]
+            if end - begin == 1:
+                i = order[begin]
+                if amounts[i] >= min_amount:
+                    graph_heads[kept_count] = heads[i]
+                    graph_amounts[kept_count] = amounts[i]
+                    kept_count += 1
+            elif end - begin > 1:
+                seen = set()
+                kept = []
+                for k in xrange(end - 1, begin - 1, -1):
+                    i = order[k]
+                    v = heads[i]
+                    if v not in seen:
+                        seen.add(v)
+                        if amounts[i] >= min_amount:
+                            kept.append(i)
+                kept.reverse()
+                for i in kept:
+                    graph_heads[kept_count] = heads[i]
+                    graph_amounts[kept_count] = amounts[i]
+                    kept_count += 1
+            offsets[u + 1] = kept_count
+            begin = end
+        _truncate(graph_heads, kept_count)
+        _truncate(graph_amounts, kept_count)
+        self._ends = offsets[1:]
+        self._cursors = offsets[:-1]
+
+    def find_components(self):
+        """
+        Finds the strongly connected components of the graph.
 
-    def _sink_vertex(self, v):
-        if v != ROOT_VERTEX:
-            try:
-                del self._vmap[v]
-            except KeyError:
-                pass
+        Returns the number of components, and an array containing the
+        component number of each vertex. This is a non-recursive
+        version of Tarjan's algorithm.
 
+        >>> graph = Digraph(5, [0, 1, 1, 2, 3], [1, 0, 2, 3, 2], [1] * 5)
+        >>> count, components = graph.find_components()
+        >>> count
+        3
+        >>> list(components)
+        [1, 1, 0, 0, 2]
+        """
 
-class IterationNode(object):
-    __slots__ = ['vertex', 'vlist_index']
+        n = self.vertex_count
+        offsets, ends, heads = self._offsets, self._ends, self._heads
+        index = array('i', [-1]) * n
+        lowlink = array('i', [0]) * n
+        components = array('i', [-1]) * n
+        is_stacked = bytearray(n)
+        stack = array('i')
+        call_stack = array('i')
+        cursors = array('i')
+        counter = 0
+        component_count = 0
+        for root in xrange(n):
+            if index[root] >= 0:
+                continue
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            is_stacked[root] = 1
+            call_stack.append(root)
+            cursors.append(offsets[root])
+            while call_stack:
+                u = call_stack[-1]
+                pos, end = cursors[-1], ends[u]
+                while pos < end:
+                    v = heads[pos]
+                    pos += 1
+                    if index[v] < 0:
+                        cursors[-1] = pos
+                        index[v] = lowlink[v] = counter
+                        counter += 1
+                        stack.append(v)
+                        is_stacked[v] = 1
+                        call_stack.append(v)
+                        cursors.append(offsets[v])
+                        break
+                    if is_stacked[v] and index[v] < lowlink[u]:
+                        lowlink[u] = index[v]
+                else:
+                    call_stack.pop()
+                    cursors.pop()
+                    if call_stack and lowlink[u] < lowlink[call_stack[-1]]:
+                        lowlink[call_stack[-1]] = lowlink[u]
+                    if lowlink[u] == index[u]:
+                        while True:
+                            v = stack.pop()
+                            is_stacked[v] = 0
+                            components[v] = component_count
+                            if v == u:
+                                break
+                        component_count += 1
+        return component_count, components
+
+    def discard_crossing_arcs(self, components):
+        """
+        Discards all arcs that connect different components.
+
+        Arcs connecting different strongly connected components can
+        not participate in any cycle. Removed arcs are discarded too,
+        and all cursors are reset.
+
+        >>> graph = Digraph(5, [0, 1, 1, 2, 3], [1, 0, 2, 3, 2], [1] * 5)
+        >>> graph.discard_crossing_arcs(graph.find_components()[1])
+        >>> list(graph._offsets)
+        [0, 1, 2, 3, 4, 4]
+        >>> list(graph._heads)
+        [1, 0, 3, 2]
+        """
+
+        offsets, ends, heads, amounts = self._offsets, self._ends, self._heads, self._amounts
+        n = self.vertex_count
+        kept = 0
+        for u in xrange(n):
+            begin, end = offsets[u], ends[u]
+            offsets[u] = kept
+            c = components[u]
+            for pos in xrange(begin, end):
+                v = heads[pos]
+                if components[v] == c:
+                    heads[kept] = v
+                    amounts[kept] = amounts[pos]
+                    kept += 1
+            ends[u] = kept
+        offsets[n] = kept
+        _truncate(heads, kept)
+        _truncate(amounts, kept)
+        self._cursors = offsets[:-1]
+
+    def _find_arc(self, u, v):
+        heads = self._heads
+        for pos in xrange(self._offsets[u], self._ends[u]):
+            if heads[pos] == v:
+                return pos
+        return -1
+
+    def has_arc(self, u, v):
+        return self._find_arc(u, v) >= 0
+
+    def remove_arc(self, u, v):
+        pos = self._find_arc(u, v)
+        if pos >= 0:
+            self._remove_arc(u, pos)
+
+    def _remove_arc(self, u, pos):
+        # The arcs before the cursor must stay before it, because they
+        # have been scanned already. Apart from that, the order of the
+        # arcs does not matter.
+        cursor = self._cursors[u]
+        if pos < cursor:
+            cursor -= 1
+            self._swap_arcs(pos, cursor)
+            self._cursors[u] = pos = cursor
+        end = self._ends[u] - 1
+        self._swap_arcs(pos, end)
+        self._ends[u] = end
 
-    def __init__(self, vertex):
-        self.vertex = vertex
-        self.vlist_index = 0
+    def _swap_arcs(self, i, j):
+        heads, amounts = self._heads, self._amounts
+        heads[i], heads[j] = heads[j], heads[i]
+        amounts[i], amounts[j] = amounts[j], amounts[i]
 
 
 class CycleFinder:
     """
-    Can find cycles in a given directed graph. (It removes arcs from the graph!)
+    Can find cycles in a given directed graph.
 
     Create the graph:
-    >>> graph = Digraph()
-    >>> graph.add_arc(-1, 2)
-    >>> graph.add_arc(2, -2)
-    >>> graph.add_arc(-2, 3)
-    >>> graph.add_arc(3, -3)    
-    >>> graph.add_arc(-3, 1)
-    >>> graph.add_arc(1, -1)
-    >>> graph.add_arc(99, 99)    
-
-    Create a cycle finder for the graph:
+    >>> graph = Digraph(7, [0, 3, 1, 4, 2, 5, 6], [3, 1, 4, 2, 5, 0, 6], [1] * 7)
+
+    Create a cycle finder for the graph. Cycles are returned as lists
+    of arc positions:
     >>> cf = CycleFinder(graph)
-    >>> cf.find_cycle()
-    [2, -2, 3, -3, 1, -1]
-    >>> cf.find_cycle()
-    [2, -2, 3, -3, 1, -1]
-
-    >>> graph.remove_arc(1, -1)
-    >>> cf.find_cycle()
-    [99]
+    >>> [graph._heads[pos] for pos in cf.find_cycle()]
+    [3, 1, 4, 2, 5, 0]
+    >>> [graph._heads[pos] for pos in cf.find_cycle()]
+    [3, 1, 4, 2, 5, 0]
+
+    >>> graph.remove_arc(5, 0)
+    >>> [graph._heads[pos] for pos in cf.find_cycle()]
+    [6]
+    >>> graph.remove_arc(6, 6)
+    >>> cf.find_cycle() is None
+    True
+
+    Vertices' cursors survive between the calls, so that every arc
+    gets scanned once, unless it participates in a found cycle. Arcs
+    leading to vertices that are known not to be on any cycle are
+    counted as skipped:
+    >>> cf.scanned_arc_count, cf.skipped_arc_count
+    (18, 0)
+
+    When the native kernel is available, it is used instead of the
+    code below. Graph's arrays must not be reallocated after the
+    cycle finder has been created.
     """
 
     def __init__(self, graph):
         self.graph = graph
-        self._listed_vertices = set()
-        self._listed_vertices.add(ROOT_VERTEX)
-        self._node_list = [IterationNode(ROOT_VERTEX)]
-        self._top = 0
-
-    def _pop_node(self):
-        vertex = self._node_list[self._top].vertex
-        self._listed_vertices.discard(vertex)
-        self._top -= 1
-        return vertex
-        
-    def _push_node(self, vertex):
-        self._listed_vertices.add(vertex)
-        self._top += 1
-        try:
-            node = self._node_list[self._top]
-        except IndexError:
-            padding = [None] * len(self._node_list)
-            self._node_list.extend(padding)
-            node = None
-        if node is None:
-            self._node_list[self._top] = IterationNode(vertex)
-        else:
-            node.vertex = vertex
-            node.vlist_index = 0
+        offsets, ends = graph._offsets, graph._ends
+        self._is_sink = bytearray(graph.vertex_count)
+        for v in xrange(graph.vertex_count):
+            if offsets[v] == ends[v]:
+                self._is_sink[v] = 1
+        self._is_listed = bytearray(graph.vertex_count)
+        self._path = array('i')
+        self._root = 0
+        self.scanned_arc_count = 0
+        self.skipped_arc_count = 0
+        self.is_native = _lib is not None
+        if self.is_native:
+            self._init_kernel()
+
+    def _init_kernel(self):
+        # The kernel works directly on graph's arrays. The buffers are
+        # referenced from "self._buffers", so that they stay alive.
+        graph = self.graph
+        n = graph.vertex_count
+        self._path = array('i', [0]) * n
+        self._cycle = array('i', [0]) * n
+        self._cycle_vertices = array('i', [0]) * n
+        self._buffers = [_ffi.from_buffer(a) for a in (
+            graph._heads, graph._amounts, graph._ends, graph._cursors, self._is_sink,
+            self._is_listed, self._path, self._cycle, self._cycle_vertices)]
+        f = self._kernel = _ffi.new('struct cycle_finder *')
+        f.vertex_count = n
+        (f.heads, f.amounts, f.ends, f.cursors, f.is_sink, f.is_listed,
+         f.path, f.cycle, f.cycle_vertices) = [
+            _ffi.cast(t, b) for t, b in zip(
+                ['int *', 'long *', 'int *', 'int *', 'char *',
+                 'char *', 'int *', 'int *', 'int *'], self._buffers)]
+
+    def _find_cycle_natively(self):
+        f = self._kernel
+        cycle_length = _lib.find_cycle(f)
+        self.scanned_arc_count = f.scanned_arc_count
+        self.skipped_arc_count = f.skipped_arc_count
+        return cycle_length
+
+    def _clear_cycle_natively(self, cycle_length, min_amount):
+        return _lib.clear_cycle(self._kernel, cycle_length, min_amount)
+
+    def _push_vertex(self, v):
+        self._is_listed[v] = 1
+        self._path.append(v)
+
+    def _pop_vertex(self):
+        self._is_listed[self._path.pop()] = 0
+
+    def _push_root(self):
+        is_sink = self._is_sink
+        root = self._root
+        while root < self.graph.vertex_count and is_sink[root]:
+            root += 1
+        self._root = root
+        if root < self.graph.vertex_count:
+            self._push_vertex(root)
+            return True
+        return False
 
     def find_cycle(self):
-        while self._top >= 0:
-            top_node = self._node_list[self._top]
-            next_vertex = None
-            try:
-                top_node_vlist = self.graph._vmap[top_node.vertex]
-                while next_vertex is None:
-                    next_vertex = top_node_vlist[top_node.vlist_index]
-                    top_node.vlist_index += 1
-            except (KeyError, IndexError):
-                self.graph._sink_vertex(top_node.vertex)
-                self._pop_node()
+        if self.is_native:
+            cycle_length = self._find_cycle_natively()
+            return self._cycle[:cycle_length].tolist() if cycle_length else None
+
+        heads, ends, cursors = self.graph._heads, self.graph._ends, self.graph._cursors
+        is_sink, is_listed = self._is_sink, self._is_listed
+        path = self._path
+        while path or self._push_root():
+            u = path[-1]
+            start, end = cursors[u], ends[u]
+            pos = start
+            while pos < end:
+                v = heads[pos]
+                pos += 1
+                if not is_sink[v]:
+                    break
+            else:
+                cursors[u] = pos
+                self.scanned_arc_count += pos - start
+                self.skipped_arc_count += pos - start
+                is_sink[u] = 1
+                self._pop_vertex()
                 continue
+            cursors[u] = pos
+            self.scanned_arc_count += pos - start
+            self.skipped_arc_count += pos - start - 1
 
-            if next_vertex in self._listed_vertices:
-                # We've got a cycle!
-                path = [next_vertex]
-                while top_node.vertex != next_vertex:
-                    path.append(top_node.vertex)
-                    self._pop_node()
-                    top_node = self._node_list[self._top]
-                top_node.vlist_index -= 1
-                path.reverse()
-                return path
+            if is_listed[v]:
+                # We've got a cycle! The cursors of cycle's vertices
+                # are moved back, so that the arcs of the cycle get
+                # scanned again.
+                i = len(path) - 1
+                while path[i] != v:
+                    i -= 1
+                cycle = []
+                for w in path[i:]:
+                    cursors[w] -= 1
+                    cycle.append(cursors[w])
+                while len(path) > i + 1:
+                    self._pop_vertex()
+                return cycle
 
-            if next_vertex in self.graph._vmap:
-                self._push_node(next_vertex)
+            self._push_vertex(v)
 
 
 class BondMatcher:
@@ -239,22 +571,23 @@ class BondMatcher:
     The minial meaningful amount is passed to the constructor.
     >>> s = BondMatcher(100)
 
-    Register some bonds:
+    Register some bonds. Vertices can be any hashable objects; they
+    get dense integer ids in the order of their registration:
     >>> s.register_bond(1, 2, 120)
     >>> s.register_bond(2, 3, 150)
-    >>> s._bonds
-    {(1, 2): 120, (2, 3): 150}
+    >>> s._vertices
+    [1, 2, 3]
 
     The next bond is void because its amount is less than 100:
     >>> s.register_bond(3, 1, 1)
-    >>> s._bonds
-    {(1, 2): 120, (2, 3): 150}
 
     This bond closes the cycle:
     >>> s.register_bond(3, 1, 250)
 
     Start the matcher and try to find a deal:
     >>> s.start()
+    >>> sorted(s._live_bonds().items())
+    [((1, 2), 120), ((2, 3), 150), ((3, 1), 250)]
     >>> path, amount = s.find_deal()
     >>> sorted(path)
     [1, 2, 3]
@@ -263,103 +596,630 @@ class BondMatcher:
     
     All bond amounts were decremented by 120. As a result two of them
     became void because their remaining amount is less than 100:
-    >>> s._bonds
+    >>> s._live_bonds()
     {(3, 1): 130}
 
     Try to find a deal again:
     >>> s.find_deal()
+
+    Before looking for cycles, the matcher splits the graph into
+    strongly connected components, discarding all arcs between
+    them. Here are the sizes (vertices, arcs) of the non-trivial
+    components, the biggest first:
+    >>> s.get_component_stats()
+    [(3, 3)]
+
+    The number of scanned arcs, and how many of them were skipped:
+    >>> s.get_scan_stats()
+    (4, 1)
+
+    The number of non-void bonds the matcher was started with:
+    >>> s.get_bond_count()
+    3
+
+    If "mmap_dir" is given, the arrays holding the bonds are kept in
+    memory-mapped temporary files in that directory, so that the OS
+    can page their cold parts out of RAM. This is slower, but allows
+    matching markets that do not fit in RAM.
     """
     
-    def __init__(self, min_amount):
+    def __init__(self, min_amount, mmap_dir=None):
         assert (min_amount > 0)
         self._min_amount = min_amount
-        self._bonds = {}
+        self._vertex_ids = {}
+        self._vertices = []
+        if mmap_dir is None:
+            self._arrays = None
+            self._tails = array('i')
+            self._heads = array('i')
+            self._amounts = array(AMOUNT_TYPECODE)
+        else:
+            self._arrays = _MmapArrays(mmap_dir)
+            self._tails = self._arrays.appendable('i')
+            self._heads = self._arrays.appendable('i')
+            self._amounts = self._arrays.appendable(AMOUNT_TYPECODE)
         self._graph = None
         self._finder = None
+        self._component_stats = None
         self._is_started = False
 
+    def _get_vertex_id(self, v):
+        try:
+            return self._vertex_ids[v]
+        except KeyError:
+            vertex_id = self._vertex_ids[v] = len(self._vertices)
+            self._vertices.append(v)
+            return vertex_id
+
     def register_bond(self, u, v, amount):
         if self._is_started:
             raise Exception('can not register bonds after started')
         elif amount >= self._min_amount:
-            self._bonds[(u, v)] = amount
-        else:
-            self._bonds.pop((u, v), None)
+            self._tails.append(self._get_vertex_id(u))
+            self._heads.append(self._get_vertex_id(v))
+            self._amounts.append(amount)
+        elif u in self._vertex_ids and v in self._vertex_ids:
+            # The void bond may cancel a previously registered one.
+            self._tails.append(self._vertex_ids[u])
+            self._heads.append(self._vertex_ids[v])
+            self._amounts.append(0)
 
     def start(self):
         if self._is_started:
             raise Exception('the bond matcher is already started')
-        self._graph = Digraph()
-        for arc in self._bonds:
-            self._graph.add_arc(*arc)
-        self._finder = CycleFinder(self._graph)
+        tails, heads, amounts = [
+            a.finish() if isinstance(a, _SpilledArray) else a
+            for a in (self._tails, self._heads, self._amounts)]
+        self._vertex_ids = self._tails = self._heads = self._amounts = None
+        self._graph = Digraph(
+            len(self._vertices), tails, heads, amounts, self._min_amount, self._arrays)
+        tails = heads = amounts = None
+        self._bond_count = self._graph._offsets[self._graph.vertex_count]
+        component_count, components = self._graph.find_components()
+        self._graph.discard_crossing_arcs(components)
+        self._component_stats = self._calc_component_stats(
+            component_count, components)
+        self._start_matching(component_count, components)
         self._is_started = True
 
+    def _start_matching(self, component_count, components):
+        self._finder = CycleFinder(self._graph)
+
+    def get_component_stats(self):
+        return self._component_stats
+
+    def get_bond_count(self):
+        return self._bond_count
+
+    def get_scan_stats(self):
+        return self._finder.scanned_arc_count, self._finder.skipped_arc_count
+
+    def _calc_component_stats(self, component_count, components):
+        graph = self._graph
+        vertex_counts = array('i', [0]) * component_count
+        arc_counts = array('i', [0]) * component_count
+        for u in xrange(graph.vertex_count):
+            c = components[u]
+            vertex_counts[c] += 1
+            arc_counts[c] += graph._ends[u] - graph._offsets[u]
+        stats = [(vertex_counts[c], arc_counts[c]) for c in xrange(component_count)
+                 if vertex_counts[c] > 1 or arc_counts[c] > 0]
+        stats.sort(reverse=True)
+        return stats
+
     def find_deal(self):
-        path = self._finder.find_cycle()
-        if path:
-            amount, updated_bonds = self._calc_cycle(path)
-            for bond in updated_bonds:
-                self._update_bond(*bond)
+        finder = self._finder
+        if finder.is_native:
+            cycle_length = finder._find_cycle_natively()
+            if cycle_length:
+                amount = finder._clear_cycle_natively(cycle_length, self._min_amount)
+                vertices = self._vertices
+                path = [vertices[v] for v in finder._cycle_vertices[:cycle_length]]
+                return path, amount
+            return None
+
+        cycle = finder.find_cycle()
+        if cycle:
+            heads, amounts = self._graph._heads, self._graph._amounts
+            vertex_ids = [heads[pos] for pos in cycle]
+            path = [self._vertices[v] for v in vertex_ids]
+            amount = min(amounts[pos] for pos in cycle)
+            for i, pos in enumerate(cycle):
+                self._update_bond(vertex_ids[i - 1], pos, amounts[pos] - amount)
             return path, amount
 
-    def _update_bond(self, u, v, amount):
-        if amount >= self._min_amount:
-            self._bonds[(u, v)] = amount
-        else:
-            self._bonds.pop((u, v), None)
-            self._graph.remove_arc(u, v)
+    def _update_bond(self, u, pos, amount):
+        self._graph._amounts[pos] = amount
+        if amount < self._min_amount:
+            self._graph._remove_arc(u, pos)
 
-    def _calc_cycle(self, path):
-        arcs = [(path[i-1], path[i]) for i in range(len(path))]        
-        amount = min(self._bonds[a] for a in arcs)
-        bonds = [(a[0], a[1], self._bonds[a] - amount) for a in arcs]
-        return amount, bonds
+    def _live_bonds(self):
+        graph = self._graph
+        bonds = {}
+        for u in xrange(graph.vertex_count):
+            for pos in xrange(graph._offsets[u], graph._ends[u]):
+                v = graph._heads[pos]
+                bonds[(self._vertices[u], self._vertices[v])] = graph._amounts[pos]
+        return bonds
 
 
-def _test_bond_matcher(trader_count, bond_count):
+class CirculationBondMatcher(BondMatcher):
     """
-    This function tests the whole module.
+    Can generate deals when loaded with bonds, clearing as much as possible.
 
-    >>> deal_count, amount, time = _test_bond_matcher(10000, 50000)
-    >>> deal_count > 5000
-    True
-    >>> amount > 1e6
+    The greedy "BondMatcher" cancels the cycles in the order it finds
+    them, which may clear much less than possible. This matcher
+    computes a maximum circulation over the bond graph instead --
+    every bond is an arc with capacity equal to bond's amount, and
+    the total flow over all arcs is maximized. The greedy solution is
+    used as a starting point, which then gets improved with the
+    cost-scaling push-relabel algorithm. The resulting circulation
+    is decomposed into cycles, and cycles' amounts less than the
+    minimal meaningful amount are not reported. Because of this, when
+    the minimal meaningful amount is greater than 1, the greedy
+    solution may clear more -- in which case the greedy deals are
+    reported instead.
+
+    Note that this is considerably slower than the greedy matcher. For
+    markets with more than CIRCULATION_MAX_BOND_COUNT bonds a warning
+    is issued, and the greedy deals are reported.
+
+    >>> s = CirculationBondMatcher(1)
+    >>> s.register_bond(1, 2, 10)
+    >>> s.register_bond(2, 3, 10)
+    >>> s.register_bond(3, 1, 10)
+    >>> s.register_bond(3, 4, 10)
+    >>> s.register_bond(4, 1, 10)
+    >>> s.register_bond(2, 4, 10)
+    >>> s.start()
+
+    The greedy matcher would clear the cycle 1-2-3-1, because it
+    happens to be found first. Instead, the longer cycle 1-2-3-4-1
+    got cleared:
+    >>> s.find_deal()
+    ([2, 3, 4, 1], 10)
+    >>> s.find_deal()
+
+    Here the maximum circulation decomposes into cycles that are all
+    smaller than 10, so the greedy deals get reported instead:
+    >>> bonds = [(1, 6, 0), (8, 5, 17), (5, 3, 19), (7, 1, 3), (2, 8, 2),
+    ...          (3, 6, 13), (3, 5, 4), (1, 2, 8), (2, 8, 9), (7, 6, 12),
+    ...          (5, 6, 8), (7, 8, 15), (3, 4, 0), (3, 1, 7), (1, 7, 18),
+    ...          (2, 6, 5), (6, 2, 20), (5, 1, 11), (3, 4, 14), (6, 3, 5),
+    ...          (3, 5, 7), (2, 7, 7), (3, 5, 12), (3, 5, 1), (4, 8, 20),
+    ...          (7, 3, 11)]
+    >>> def get_cleared_amount(m):
+    ...     for bond in bonds:
+    ...         m.register_bond(*bond)
+    ...     m.start()
+    ...     return _get_cleared_amount(iter(m.find_deal, None))
+    >>> get_cleared_amount(BondMatcher(10))
+    56
+    >>> get_cleared_amount(CirculationBondMatcher(10))
+    56
+    """
+
+    def __init__(self, min_amount, mmap_dir=None):
+        BondMatcher.__init__(self, min_amount, mmap_dir)
+        self._scan_stats = None
+        self._deals = None
+
+    def _start_matching(self, component_count, components):
+        # Only the graph used by the greedy solution, and the one used
+        # for the decomposition are memory-mapped.
+        graph = self._graph
+        offsets = graph._offsets
+        arc_count = offsets[graph.vertex_count]
+        if arc_count > CIRCULATION_MAX_BOND_COUNT:
+            warnings.warn('%i bonds are too many for finding the maximum circulation, '
+                          'matching greedily instead' % arc_count)
+            BondMatcher._start_matching(self, component_count, components)
+            return
+
+        initial_heads = array('i', graph._heads[:arc_count])
+        capacities = array(AMOUNT_TYPECODE, graph._amounts[:arc_count])
+        tails = array('i', [0]) * len(capacities)
+        for u in xrange(graph.vertex_count):
+            for pos in xrange(offsets[u], offsets[u + 1]):
+                tails[pos] = u
+
+        # Start from the greedy solution.
+        BondMatcher._start_matching(self, component_count, components)
+        greedy_deals = list(iter(lambda: BondMatcher.find_deal(self), None))
+        self._scan_stats = BondMatcher.get_scan_stats(self)
+
+        # The greedy matcher might have reordered vertices' arcs.
+        heads = array('i', graph._heads[:arc_count])
+        flows = array(AMOUNT_TYPECODE, [0]) * len(capacities)
+        for u in xrange(graph.vertex_count):
+            begin, end = offsets[u], offsets[u + 1]
+            if end - begin > 1:
+                capacity = dict(zip(initial_heads[begin:end], capacities[begin:end]))
+                for pos in xrange(begin, end):
+                    capacities[pos] = capacity[heads[pos]]
+            for pos in xrange(begin, end):
+                flows[pos] = capacities[pos] - graph._amounts[pos]
+        initial_heads = None
+
+        residual = _ResidualGraph(
+            graph.vertex_count, graph._offsets, tails, heads, capacities, flows)
+        residual.find_min_cost_circulation()
+
+        # Decompose the circulation into cycles.
+        decomposition = BondMatcher(1)
+        decomposition._arrays = self._arrays
+        decomposition._vertices = self._vertices
+        decomposition._tails = tails
+        decomposition._heads = heads
+        decomposition._amounts = flows
+        self._graph = self._finder = None
+        decomposition.start()
+        deals = [deal for deal in iter(decomposition.find_deal, None)
+                 if deal[1] >= self._min_amount]
+
+        # Dropping the cycles whose amounts are less than the minimal
+        # meaningful amount may lose more than the greedy solution
+        # does.
+        if _get_cleared_amount(deals) < _get_cleared_amount(greedy_deals):
+            deals = greedy_deals
+        self._deals = iter(deals)
+
+    def get_scan_stats(self):
+        if self._deals is None:
+            return BondMatcher.get_scan_stats(self)
+        return self._scan_stats
+
+    def find_deal(self):
+        if self._deals is None:
+            return BondMatcher.find_deal(self)
+        return next(self._deals, None)
+
+
+def _get_cleared_amount(deals):
+    return sum(len(path) * amount for path, amount in deals)
+
+
+_COST_SCALING_FACTOR = 4
+
+
+class _ResidualGraph:
+    """
+    The residual graph of a flow, with arc costs -1 (forward) and +1 (backward).
+
+    Residual arcs are referred to by codes: "2 * pos" is the forward
+    arc at position "pos", and "2 * pos + 1" is the backward one.
+    """
+
+    def __init__(self, vertex_count, offsets, tails, heads, capacities, flows):
+        self.vertex_count = vertex_count
+        self._offsets = offsets
+        self._tails = tails
+        self._heads = heads
+        self._capacities = capacities
+        self.flows = flows
+
+        # Index the arcs by their heads (a stable counting sort).
+        n = vertex_count
+        in_offsets = array('i', [0]) * (n + 1)
+        for v in heads:
+            in_offsets[v + 1] += 1
+        for v in xrange(n):
+            in_offsets[v + 1] += in_offsets[v]
+        in_arcs = array('i', [0]) * len(heads)
+        starts = array('i', in_offsets)
+        for pos in xrange(len(heads)):
+            v = heads[pos]
+            in_arcs[starts[v]] = pos
+            starts[v] += 1
+        self._in_offsets = in_offsets
+        self._in_arcs = in_arcs
+
+    def find_min_cost_circulation(self):
+        """Changes the flow until its cost is minimal."""
+
+        # This is the cost-scaling push-relabel algorithm of Goldberg
+        # and Tarjan. Arc costs are multiplied by "n + 1", so that the
+        # flow is optimal once it is 1-optimal. The vertices' prices
+        # start from zero, so the initial flow is "n + 1"-optimal.
+        n = self.vertex_count
+        offsets, heads, tails = self._offsets, self._heads, self._tails
+        in_offsets, in_arcs = self._in_offsets, self._in_arcs
+        capacities, flows = self._capacities, self.flows
+        cost = n + 1
+
+        # The residual arcs going out from every vertex, as codes.
+        arc_offsets = array('i', [0]) * (n + 1)
+        codes = array('i', [0]) * (2 * len(heads))
+        k = 0
+        for u in xrange(n):
+            for pos in xrange(offsets[u], offsets[u + 1]):
+                codes[k] = pos << 1
+                k += 1
+            for i in xrange(in_offsets[u], in_offsets[u + 1]):
+                codes[k] = (in_arcs[i] << 1) | 1
+                k += 1
+            arc_offsets[u + 1] = k
+
+        prices = [0] * n
+        excesses = [0] * n
+        epsilon = cost
+        while epsilon > 1:
+            epsilon = max(epsilon // _COST_SCALING_FACTOR, 1)
+
+            # Saturate all residual arcs having negative reduced costs.
+            # The flow becomes 0-optimal, but not a circulation.
+            for pos in xrange(len(heads)):
+                u, v = tails[pos], heads[pos]
+                reduced_cost = prices[u] - prices[v] - cost
+                if reduced_cost < 0:
+                    amount = capacities[pos] - flows[pos]
+                elif reduced_cost > 0:
+                    amount = -flows[pos]
+                else:
+                    continue
+                if amount:
+                    flows[pos] += amount
+                    excesses[u] -= amount
+                    excesses[v] += amount
+
+            # Push the excesses along admissible arcs, relabeling
+            # vertices when needed, so that the flow becomes an
+            # "epsilon"-optimal circulation again.
+            current_arcs = array('i', arc_offsets[:n])
+            queue = deque(u for u in xrange(n) if excesses[u] > 0)
+            while queue:
+                u = queue.popleft()
+                excess = excesses[u]
+                price = prices[u]
+                k, end = current_arcs[u], arc_offsets[u + 1]
+                while excess > 0:
+                    if k == end:
+                        # Relabel.
+                        max_price = None
+                        for i in xrange(arc_offsets[u], end):
+                            code = codes[i]
+                            pos = code >> 1
+                            if code & 1:
+                                if flows[pos] > 0:
+                                    p = prices[tails[pos]] - cost
+                                    if max_price is None or p > max_price:
+                                        max_price = p
+                            elif flows[pos] < capacities[pos]:
+                                p = prices[heads[pos]] + cost
+                                if max_price is None or p > max_price:
+                                    max_price = p
+                        price = prices[u] = max_price - epsilon
+                        k = arc_offsets[u]
+                        continue
+                    code = codes[k]
+                    pos = code >> 1
+                    if code & 1:
+                        v = tails[pos]
+                        residual = flows[pos]
+                        admissible = residual > 0 and price - prices[v] + cost < 0
+                    else:
+                        v = heads[pos]
+                        residual = capacities[pos] - flows[pos]
+                        admissible = residual > 0 and price - prices[v] - cost < 0
+                    if not admissible:
+                        k += 1
+                        continue
+                    amount = min(excess, residual)
+                    flows[pos] += -amount if code & 1 else amount
+                    excess -= amount
+                    v_excess = excesses[v]
+                    excesses[v] = v_excess + amount
+                    if v_excess <= 0 < v_excess + amount:
+                        queue.append(v)
+                excesses[u] = 0
+                current_arcs[u] = k
+
+
+class ParallelBondMatcher(BondMatcher):
+    """
+    Can generate deals when loaded with bonds, using a pool of worker processes.
+
+    The strongly connected components of the graph are independent
+    from each other, so they are shipped to the worker processes in
+    batches and matched there. The deals are reported in a fixed
+    order that does not depend on the number of worker processes.
+    The matcher class that the workers use can be given explicitly.
+
+    >>> s = ParallelBondMatcher(100, jobs=2)
+    >>> s.register_bond(1, 2, 120)
+    >>> s.register_bond(2, 1, 150)
+    >>> s.register_bond(3, 4, 200)
+    >>> s.register_bond(4, 3, 300)
+    >>> s.register_bond(2, 3, 1000)
+    >>> s.start()
+    >>> s.find_deal()
+    ([4, 3], 200)
+    >>> s.find_deal()
+    ([2, 1], 120)
+    >>> s.find_deal()
+    """
+
+    # Small components are shipped to the workers in batches, so that
+    # each batch contains at least that many arcs.
+    BATCH_SIZE = 50000
+
+    def __init__(self, min_amount, jobs, matcher_class=BondMatcher, mmap_dir=None):
+        assert (jobs > 0)
+        BondMatcher.__init__(self, min_amount, mmap_dir)
+        self._mmap_dir = mmap_dir
+        self._jobs = jobs
+        self._matcher_class = matcher_class
+        self._scanned_arc_count = 0
+        self._skipped_arc_count = 0
+        self._deals = None
+
+    def _start_matching(self, component_count, components):
+        pool = multiprocessing.Pool(self._jobs)
+        batches = self._generate_batches(component_count, components)
+        self._deals = self._generate_deals(pool, pool.imap(_match_batch, batches))
+
+    def _generate_batches(self, component_count, components):
+        graph = self._graph
+        offsets, ends = graph._offsets, graph._ends
+        heads, amounts = graph._heads, graph._amounts
+        n = graph.vertex_count
+
+        # Sort the vertices by their components (a counting sort).
+        starts = array('i', [0]) * (component_count + 1)
+        for c in components:
+            starts[c + 1] += 1
+        for c in xrange(component_count):
+            starts[c + 1] += starts[c]
+        ordered_vertices = array('i', [0]) * n
+        for u in xrange(n):
+            c = components[u]
+            ordered_vertices[starts[c]] = u
+            starts[c] += 1
+
+        # Ship the components that have arcs in batches. Vertices get
+        # new ids, local to their components.
+        local_ids = array('i', [0]) * n
+        batch, batch_arc_count = [], 0
+        begin = 0
+        for c in xrange(component_count):
+            end = starts[c]
+            vertices = ordered_vertices[begin:end]
+            begin = end
+            if len(vertices) == 1 and offsets[vertices[0]] == ends[vertices[0]]:
+                continue
+            for local_id, u in enumerate(vertices):
+                local_ids[u] = local_id
+            tails, local_heads = array('i'), array('i')
+            local_amounts = array(AMOUNT_TYPECODE)
+            for local_id, u in enumerate(vertices):
+                for pos in xrange(offsets[u], ends[u]):
+                    tails.append(local_id)
+                    local_heads.append(local_ids[heads[pos]])
+                    local_amounts.append(amounts[pos])
+            batch.append((
+                vertices.tostring(), tails.tostring(),
+                local_heads.tostring(), local_amounts.tostring()))
+            batch_arc_count += len(tails)
+            if batch_arc_count >= self.BATCH_SIZE:
+                yield self._matcher_class, self._min_amount, self._mmap_dir, batch
+                batch, batch_arc_count = [], 0
+        if batch:
+            yield self._matcher_class, self._min_amount, self._mmap_dir, batch
+
+    def _generate_deals(self, pool, results):
+        vertices = self._vertices
+        try:
+            for deals, scanned_arc_count, skipped_arc_count in results:
+                self._scanned_arc_count += scanned_arc_count
+                self._skipped_arc_count += skipped_arc_count
+                for path, amount in deals:
+                    yield [vertices[v] for v in path], amount
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def find_deal(self):
+        return next(self._deals, None)
+
+    def get_scan_stats(self):
+        return self._scanned_arc_count, self._skipped_arc_count
+
+
+def _match_batch(task):
+    matcher_class, min_amount, mmap_dir, batch = task
+    deals = []
+    scanned_arc_count = skipped_arc_count = 0
+    for vertices, tails, heads, amounts in batch:
+        # The bonds are already in RAM, so the matcher is created
+        # without spill files. Only its graph gets memory-mapped.
+        m = matcher_class(min_amount)
+        m._arrays = None if mmap_dir is None else _MmapArrays(mmap_dir)
+        m._vertices = array('i', vertices).tolist()
+        m._tails = array('i', tails)
+        m._heads = array('i', heads)
+        m._amounts = array(AMOUNT_TYPECODE, amounts)
+        m.start()
+        while True:
+            deal = m.find_deal()
+            if not deal:
+                break
+            deals.append(deal)
+        scanned, skipped = m.get_scan_stats()
+        scanned_arc_count += scanned
+        skipped_arc_count += skipped
+    return deals, scanned_arc_count, skipped_arc_count
+
+
+def generate_market(trader_count, bond_count, sellers_ratio=0.1, locality_distance=10000,
+                    avg_amount=100, distribution='exponential', seed=1):
+    """
+    Generates a synthetic market, yielding "(buyer, seller, amount)" bonds.
+
+    Every tenth trader issues a product. Traders buy mostly products
+    issued by "near" traders ("locality_distance" controls how near),
+    and only "sellers_ratio" of the bonds are offers to sell. Sell
+    offers are bigger, so that on average the total amounts offered
+    to buy and to sell are the same. Amounts are drawn either from an
+    exponential, or from a uniform distribution with the given mean:
+    >>> bonds = list(generate_market(100, 1000))
+    >>> len(bonds)
+    1000
+    >>> bonds == list(generate_market(100, 1000))
     True
+    >>> bonds == list(generate_market(100, 1000, seed=2))
+    False
     """
-    import random, time
+    import random
 
-    product_count = trader_count // 10
-    sellers_ratio = 0.1
-    avg_sell_amount = 100 * 1 / sellers_ratio
+    assert distribution in ('exponential', 'uniform')
+    rnd = random.Random(seed)
+    product_count = max(trader_count // 10, 1)
+    locality_distance = min(trader_count, locality_distance)
+    avg_sell_amount = avg_amount / sellers_ratio
     avg_buy_amount = sellers_ratio * avg_sell_amount
-    locality_distance = min(trader_count, 10000)
 
-    random.seed(1)
-    lambd_sell = 1 / avg_sell_amount
-    lambd_buy = 1 / avg_buy_amount
-    trader_list = [(i, 0) for i in xrange(1, trader_count+1)]
+    def generate_amount(mean):
+        if distribution == 'exponential':
+            return int(rnd.expovariate(1 / mean))
+        else:
+            return int(rnd.uniform(0, 2 * mean))
+
     producer_list = []
     for i in xrange(1, product_count+1):
-        producer_list.append((random.randrange(1, trader_count+1), i))
-
-    bond_list = []
-    while len(bond_list) < bond_count:
-        producer = random.choice(producer_list)
-        trader_list_index = (
-            producer[0] - 1 + random.randrange(locality_distance+1)
-            ) % trader_count
-        trader = trader_list[trader_list_index]
-        if random.random() < sellers_ratio:
-            amount = int(random.expovariate(lambd_sell))
+        producer_list.append((rnd.randrange(1, trader_count+1), i))
+
+    for _ in xrange(bond_count):
+        producer = rnd.choice(producer_list)
+        trader = ((producer[0] - 1 + rnd.randrange(locality_distance+1)) % trader_count + 1, 0)
+        if rnd.random() < sellers_ratio:
+            amount = generate_amount(avg_sell_amount)
             buyer, seller = producer, trader  # the switch is 2x slower!
         else:
-            amount = int(random.expovariate(lambd_buy))
+            amount = generate_amount(avg_buy_amount)
             buyer, seller = trader, producer
-        bond_list.append((pair2str(*buyer), pair2str(*seller), amount))
+        yield pair2int(*buyer), pair2int(*seller), amount
+
+
+def _test_bond_matcher(trader_count, bond_count, mmap_dir=None):
+    """
+    This function tests the whole module.
 
+    >>> deal_count, amount, time = _test_bond_matcher(10000, 50000)
+    >>> deal_count > 5000
+    True
+    >>> amount > 1e6
+    True
+
+    Memory-mapped arrays give the same result:
+    >>> _test_bond_matcher(10000, 50000, tempfile.gettempdir())[:2] == (deal_count, amount)
+    True
+    """
+    import time
+
+    bond_list = list(generate_market(trader_count, bond_count))
     zero_time = time.time()
-    m = BondMatcher(1)
+    m = BondMatcher(1, mmap_dir)
     for b in bond_list:
         m.register_bond(*b)
     m.start()
@@ -377,5 +1237,12 @@ def _test_bond_matcher(trader_count, bond_count):
 
 if __name__ == '__main__':
     import doctest
+    print('Testing the %s implementation' % ('native' if _lib is not None else 'pure-Python'))
     doctest.testmod()
 
+    # Test the pure-Python implementation too.
+    if _lib is not None:
+        _ffi = _lib = None
+        print('Testing the pure-Python implementation')
+        doctest.testmod()
+
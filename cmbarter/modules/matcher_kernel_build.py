@@ -0,0 +1,196 @@
+## The author disclaims copyright to this source code.  In place of
+## a legal notice, here is a poem:
+##
+##   "Metaphysics"
+##   
+##   Matter: is the music 
+##   of the space.
+##   Music: is the matter
+##   of the soul.
+##   
+##   Soul: is the space
+##   of God.
+##   Space: is the soul
+##   of logic.
+##   
+##   Logic: is the god
+##   of the mind.
+##   God: is the logic
+##   of bliss.
+##   
+##   Bliss: is a mind
+##   of music.
+##   Mind: is the bliss
+##   of the matter.
+##   
+######################################################################
+## This file builds an optional native kernel for the cycle search
+## performed by "matcher.py". When the kernel is not built, the
+## pure-Python implementation is used instead. To build it, run:
+##
+##   $ python cmbarter/modules/matcher_kernel_build.py
+##
+import os
+from cffi import FFI
+
+
+CDEF = """
+    struct cycle_finder {
+        int vertex_count;
+        int *heads;
+        long *amounts;
+        int *ends;
+        int *cursors;
+        char *is_sink;
+        char *is_listed;
+        int *path;
+        int path_length;
+        int root;
+        int *cycle;
+        int *cycle_vertices;
+        long scanned_arc_count;
+        long skipped_arc_count;
+    };
+
+    int find_cycle(struct cycle_finder *f);
+    long clear_cycle(struct cycle_finder *f, int cycle_length, long min_amount);
+"""
+
+
+# The functions below do exactly what "CycleFinder.find_cycle",
+# "BondMatcher.find_deal", and "Digraph._remove_arc" do.
+SOURCE = """
+    struct cycle_finder {
+        int vertex_count;
+        int *heads;
+        long *amounts;
+        int *ends;
+        int *cursors;
+        char *is_sink;
+        char *is_listed;
+        int *path;
+        int path_length;
+        int root;
+        int *cycle;
+        int *cycle_vertices;
+        long scanned_arc_count;
+        long skipped_arc_count;
+    };
+
+    static void push_vertex(struct cycle_finder *f, int v) {
+        f->is_listed[v] = 1;
+        f->path[f->path_length++] = v;
+    }
+
+    static void pop_vertex(struct cycle_finder *f) {
+        f->is_listed[f->path[--f->path_length]] = 0;
+    }
+
+    static int push_root(struct cycle_finder *f) {
+        int root = f->root;
+        while (root < f->vertex_count && f->is_sink[root])
+            root++;
+        f->root = root;
+        if (root < f->vertex_count) {
+            push_vertex(f, root);
+            return 1;
+        }
+        return 0;
+    }
+
+    static void swap_arcs(struct cycle_finder *f, int i, int j) {
+        int head = f->heads[i];
+        long amount = f->amounts[i];
+        f->heads[i] = f->heads[j];
+        f->amounts[i] = f->amounts[j];
+        f->heads[j] = head;
+        f->amounts[j] = amount;
+    }
+
+    static void remove_arc(struct cycle_finder *f, int u, int pos) {
+        int cursor = f->cursors[u];
+        if (pos < cursor) {
+            cursor--;
+            swap_arcs(f, pos, cursor);
+            f->cursors[u] = pos = cursor;
+        }
+        f->ends[u]--;
+        swap_arcs(f, pos, f->ends[u]);
+    }
+
+    /* Returns the length of the found cycle, or 0. The arc positions
+       of the cycle are stored in "f->cycle". */
+    int find_cycle(struct cycle_finder *f) {
+        int *heads = f->heads, *ends = f->ends, *cursors = f->cursors, *path = f->path;
+        char *is_sink = f->is_sink, *is_listed = f->is_listed;
+        int u, v, pos, start, end, i, n;
+
+        while (f->path_length > 0 || push_root(f)) {
+            u = path[f->path_length - 1];
+            start = cursors[u];
+            end = ends[u];
+            v = -1;
+            for (pos = start; pos < end; ) {
+                v = heads[pos++];
+                if (!is_sink[v])
+                    break;
+                v = -1;
+            }
+            cursors[u] = pos;
+            f->scanned_arc_count += pos - start;
+            if (v < 0) {
+                f->skipped_arc_count += pos - start;
+                is_sink[u] = 1;
+                pop_vertex(f);
+                continue;
+            }
+            f->skipped_arc_count += pos - start - 1;
+
+            if (is_listed[v]) {
+                i = f->path_length - 1;
+                while (path[i] != v)
+                    i--;
+                for (n = 0; i + n < f->path_length; n++)
+                    f->cycle[n] = --cursors[path[i + n]];
+                while (f->path_length > i + 1)
+                    pop_vertex(f);
+                return n;
+            }
+
+            push_vertex(f, v);
+        }
+        return 0;
+    }
+
+    /* Subtracts the smallest amount on the cycle from all its arcs,
+       and removes the arcs that became void. Returns the subtracted
+       amount. The heads of the cycle's arcs are stored in
+       "f->cycle_vertices". */
+    long clear_cycle(struct cycle_finder *f, int cycle_length, long min_amount) {
+        int i, pos;
+        long amount = f->amounts[f->cycle[0]];
+
+        for (i = 0; i < cycle_length; i++) {
+            pos = f->cycle[i];
+            f->cycle_vertices[i] = f->heads[pos];
+            if (f->amounts[pos] < amount)
+                amount = f->amounts[pos];
+        }
+        for (i = 0; i < cycle_length; i++) {
+            pos = f->cycle[i];
+            f->amounts[pos] -= amount;
+            if (f->amounts[pos] < min_amount)
+                remove_arc(f, f->cycle_vertices[(i + cycle_length - 1) % cycle_length], pos);
+        }
+        return amount;
+    }
+"""
+
+
+ffibuilder = FFI()
+ffibuilder.cdef(CDEF)
+ffibuilder.set_source('cmbarter.modules._matcher_kernel', SOURCE, extra_compile_args=['-O2'])
+
+
+if __name__ == '__main__':
+    ffibuilder.compile(tmpdir=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
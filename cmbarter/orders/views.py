@@ -45,7 +45,8 @@ from cmbarter.orders import forms
 from cmbarter.modules import curiousorm, utils
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 
 @has_profile(db)
@@ -45,7 +45,8 @@ from cmbarter.products import forms
 from cmbarter.modules import curiousorm, utils
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 PRICE_FIELD_NAME = re.compile(r'^price-([0-9]{1,9})$')
 MIN_PRICE = decimal.Decimal('0.01')
@@ -200,19 +201,24 @@ def show_partner_pricelist(request, user, partner_id_str, tmpl='partner_pricelis
     trust = db.get_trust(user['trader_id'], partner_id)
     
     if trust:
+        batch = db.batch()
+        batch.get_deposit_list(user['trader_id'], partner_id)
+        batch.get_shopping_item_list(user['trader_id'], partner_id)
+        batch.get_product_offer_list(partner_id)
+        deposit_list, shopping_item_list, offers = batch.execute()
+
         # Get user's deposited amounts.
         deposits = {}
-        for row in db.get_deposit_list(user['trader_id'], partner_id):
+        for row in deposit_list:
             deposits[row['promise_id']] = row['amount']
 
         # Get the set of products that are included in user's shopping-list.
         chosen_products = set()
-        for row in db.get_shopping_item_list(user['trader_id'], partner_id):
+        for row in shopping_item_list:
             chosen_products.add(row['promise_id'])
             
         # Get partners's pricelist.
         products = []
-        offers = db.get_product_offer_list(partner_id)
         offers.sort(key=lambda row: (row['title'].lower(), row['unit'].lower(), row['promise_id']))
         for o in offers:
             promise_id = o['promise_id']
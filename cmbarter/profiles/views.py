@@ -55,7 +55,8 @@ except ImportError:
 image_processing_lock = threading.Lock()
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 
 @has_profile(db)
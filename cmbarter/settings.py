@@ -99,6 +99,7 @@ CONFIG = {
     'CMBARTER_HOST_IS_SPAM_LISTED' : False,
     'CMBARTER_HISTORY_HORISON_DAYS' : 26,
     'CMBARTER_SESSION_INVALIDATION_MINUTES' : 60,
+    'CMBARTER_STATEMENT_CACHE_SIZE' : 0,  # Prepared stored procedure calls per connection.
     'CMBARTER_PRICE_PREFIXES' : set([u'', u'$', u'\u00A3', u'\u20AC']),
     'CMBARTER_PRICE_SUFFIXES' : set([u'', u'\u20AC', u'ЛВ', u'ЛВ.']),
     'CMBARTER_TRX_COST_QUOTA' : 50000.0,
@@ -55,7 +55,8 @@ from base64 import b64encode, b64decode
 from pytz import common_timezones
 
 
-db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True)
+db = curiousorm.Database(settings.CMBARTER_DSN, dictrows=True,
+                         statement_cache_size=settings.CMBARTER_STATEMENT_CACHE_SIZE)
 
 TRADER_ID_STRING = re.compile(r'^[0-9]{1,9}$')
 SSI_HOST = re.compile(br'<!--\s*#echo\s*var="HTTP_HOST"\s*-->')
@@ -27,16 +27,21 @@
 ######################################################################
 ## This file implements the trading turn execution procedure.
 ##
-import sys, getopt
+import sys, getopt, json, resource
+from io import BytesIO
 from decimal import Decimal
 from time import time
+from contextlib import contextmanager
 from cmbarter.settings import CMBARTER_DSN
 from cmbarter.modules import curiousorm
-from cmbarter.modules.matcher import BondMatcher, pair2str, str2pair
+from cmbarter.modules.matcher import (
+    BondMatcher, CirculationBondMatcher, ParallelBondMatcher, pair2int, int2pair)
 
 
 USAGE = """Usage: execute_turn.py [OPTIONS]
 Executes a trading turn if the time has come.
+A trading turn interrupted by a crash is resumed from its last completed
+stage (at most 3 times). A turn that fails with an error is abandoned.
 
   -h, --help
          Display this help and exit.
@@ -44,9 +49,61 @@ Executes a trading turn if the time has come.
   -n, --no-cluster
          Does not perform database table clustering.
 
+  --housekeeping-budget=SECONDS
+         Housekeeping is performed in batches after the trading turn,
+         while users' requests are being served, until SECONDS have
+         passed (default: 600). The rest will be done after the next
+         trading turns.
+
+  --housekeeping-batch-size=INTEGER
+         The maximal number of records of every kind processed in
+         one database transaction (default: 10000).
+
+  --cluster-budget=SECONDS
+         Tables are clustered one by one before users' requests are
+         served again, as long as clustering the next table is
+         expected to finish within SECONDS (default: 60). The
+         expectation is based on table's size. Tables that did not
+         get their turn will be clustered after the next trading
+         turns.
+
+  --cluster-threshold=FLOAT
+         A table is clustered only if the ratio of its rows changed
+         since it was last clustered exceeds FLOAT (default: 0.2).
+
+  -b, --bulk-write
+         Writes the deals to the database with a few set-based
+         statements, instead of row by row. The outcome is exactly
+         the same, but this is much faster for big trading turns.
+
   --dsn=DSN
          Give explicitly the database source name.
 
+  --engine=ENGINE
+         Selects the way trading cycles are found (default: greedy).
+
+         --engine=greedy
+             Clears the cycles in the order they are found. This is
+             fast, but may clear much less than possible.
+         --engine=circulation
+             Computes a maximum circulation over the trading graph,
+             and clears it. This is slow, but clears more volume.
+             Not suitable for big markets: trading graphs with more
+             than 200000 bonds are cleared greedily, and a warning
+             is issued.
+
+  --copy-rows=INTEGER
+         The number of matched commitments written to the database
+         in one transaction (default: 100000).
+
+  --jobs=INTEGER
+         The number of worker processes that match commitments
+         (default: 1).
+
+         Independent parts of the trading graph are matched in
+         parallel. The generated deals do not depend on the number
+         of worker processes.
+
   --level=INTEGER
          Controls how big the MCV should be.
 
@@ -61,70 +118,220 @@ Executes a trading turn if the time has come.
          --level=2 (MCV=1)
          --level=3 (MCV=10)
          --level=4 (MCV=100)
-                               
-Example:
-  $ ./execute_turn.py -n --level=3
-"""
-
-
 
-def commitments():
-    return curiousorm.Cursor(dsn, """
-        SELECT recipient_id, issuer_id, promise_id, value
-        FROM commitment
-        ORDER BY ordering_number
-        """, dictrows=True)
+  --mmap-dir=DIR
+         Keeps the bonds in memory-mapped temporary files in DIR, so
+         that the operating system can page their cold parts out of
+         RAM. This is slower, but allows matching very big markets
+         with limited RAM. With "--engine=circulation", the maximum
+         circulation itself is always computed in RAM. Only the bonds,
+         and the graph matched greedily, are memory-mapped.
+
+  --time-budget=SECONDS
+         Chooses the MCV automatically, so that matching commitments
+         is expected to take no more than SECONDS. The expectation is
+         based on the distribution of commitments' values, and on the
+         timings recorded during the previous trading turns. If the
+         matching finishes early, the unmatched amounts are matched
+         again with a lower MCV. The value of --level becomes the
+         lowest allowed level.
+
+  --report=FILE
+         Writes the durations, the row counts, and the peak memory
+         usage of turn's stages to FILE, in JSON format. These are
+         recorded in the "turn_stats" table as well.
+
+  --rebuild-commitments
+         Calculates all commitments from scratch during the trading
+         turn, instead of updating only those that might have
+         changed. This is done automatically after upgrading from a
+         version that did not keep the commitments between turns.
+
+  --dry-run
+         Matches the current commitments without executing a trading
+         turn. Nothing is written to the database, the solver is not
+         locked, and the site stays online. The number of deals, the
+         cleared value, and the durations of the stages are printed
+         in JSON format. Can be used together with --level, --engine,
+         --jobs, and --report to evaluate settings on real data.
 
+Example:
+  $ ./execute_turn.py -n --level=3 --jobs=4
+"""
 
 
-class BufferedInserter:
-    BUFFER_SIZE = 10000
-    
-    def __init__(self, connection, template):
+ENGINES = {
+    'greedy': BondMatcher,
+    'circulation': CirculationBondMatcher,
+    }
+
+USER_LIMITS_BATCH_SIZE = 10000
+
+# The assumed clustering speed, in bytes per second, until the
+# clustering of a table has been measured.
+CLUSTER_BYTES_PER_SECOND = 20.0 * 2**20
+
+MATCHING_HISTORY_TURN_COUNT = 10
+
+# The last completed stage of a trading turn, as recorded in
+# "solver.checkpoint".
+CHECKPOINT_NONE = 0
+CHECKPOINT_PREPARED = 1
+CHECKPOINT_MATCHED = 2
+CHECKPOINT_WRITTEN = 3
+
+
+def load_commitments(db, matcher, table='commitment', matched_amounts=None):
+    # Commitments' values are copied as integer cents, so that no
+    # "Decimal" instances are created. The order in which bonds are
+    # registered determines which cycles get cleared first, so
+    # commitments are shuffled anew every time, to be fair to all
+    # traders.
+    loader = CommitmentLoader(matcher, matched_amounts)
+    db.copy_expert("""
+        COPY (
+          SELECT recipient_id, issuer_id, promise_id, (value * 100)::bigint
+          FROM %s
+          ORDER BY RANDOM()
+        ) TO STDOUT
+        """ % table, loader, size=65536)
+    return loader.row_count
+
+
+
+class CommitmentLoader:
+    r"""A file-like object that registers COPY-ed commitments as bonds.
+
+    If "matched_amounts" is given, the amounts already matched are
+    subtracted from the bonds' amounts.
+
+    >>> class Matcher:
+    ...     def __init__(self):
+    ...         self.bonds = []
+    ...     def register_bond(self, u, v, amount):
+    ...         self.bonds.append((u, v, amount))
+    >>> m = Matcher()
+    >>> loader = CommitmentLoader(m)
+    >>> loader.write('1\t2\t3\t1500\n4\t5')
+    >>> loader.write('\t6\t-250\n')
+    >>> loader.row_count
+    2
+    >>> m.bonds == [commitment2bond(1, 2, 3, 1500), commitment2bond(4, 5, 6, -250)]
+    True
+
+    >>> m = Matcher()
+    >>> u, v, amount = commitment2bond(1, 2, 3, 1500)
+    >>> loader = CommitmentLoader(m, {(u, v): 500})
+    >>> loader.write('1\t2\t3\t1500\n')
+    >>> m.bonds == [(u, v, 1000)]
+    True
+    """
+
+    def __init__(self, matcher, matched_amounts=None):
+        self.matcher = matcher
+        self.matched_amounts = matched_amounts
+        self.unfinished_line = ''
+        self.row_count = 0
+
+    def write(self, data):
+        lines = (self.unfinished_line + data).split('\n')
+        self.unfinished_line = lines.pop()
+        self.row_count += len(lines)
+        register_bond = self.matcher.register_bond
+        if self.matched_amounts:
+            get_matched_amount = self.matched_amounts.get
+            for line in lines:
+                recipient_id, issuer_id, promise_id, value = line.split('\t')
+                u, v, amount = commitment2bond(
+                    int(recipient_id), int(issuer_id), int(promise_id), int(value))
+                register_bond(u, v, amount - get_matched_amount((u, v), 0))
+        else:
+            for line in lines:
+                recipient_id, issuer_id, promise_id, value = line.split('\t')
+                register_bond(*commitment2bond(
+                        int(recipient_id), int(issuer_id), int(promise_id), int(value)))
+
+
+
+class BufferedCopyWriter:
+    r"""Writes rows to a table with COPY, one transaction per buffer.
+
+    The values are written in COPY's text format:
+    >>> w = BufferedCopyWriter(None, 'example', ['a', 'b', 'c', 'd'])
+    >>> w.insert((1, Decimal('-2.50'), None, u'x\ty\\z\n'), flush_if_full=False)
+    >>> w.buffer.getvalue().split('\t')
+    ['1', '-2.50', '\\N', 'x\\ty\\\\z\\n\n']
+    """
+
+    BUFFER_SIZE = 100000
+
+    def __init__(self, connection, table, columns, buffer_size=None):
         self.connection = connection
-        self.template = template
-        self.rows = []
+        self.statement = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns))
+        self.buffer_size = buffer_size or self.BUFFER_SIZE
+        self.buffer = BytesIO()
+        self.row_count = 0
+        self.written_row_count = 0
+        self.seconds = 0.0
 
     def insert(self, row, flush_if_full=True):
-        self.rows.append(row)
+        self.buffer.write('\t'.join(map(format_copy_value, row)) + '\n')
+        self.row_count += 1
         if flush_if_full:
             self.flush_if_full()
 
     def flush(self):
-        if self.rows:
-            values = (','.join(map(str, row)) for row in self.rows)
-            values_str = '),('.join(values)
+        if self.row_count:
+            started_at = time()
+            self.buffer.seek(0)
             with self.connection.Transaction() as trx:
                 trx.set_asynchronous_commit()
-                trx.execute(self.template % values_str)
-            self.rows = []
+                trx.copy_expert(self.statement, self.buffer, size=65536)
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.written_row_count += self.row_count
+            self.row_count = 0
+            self.seconds += time() - started_at
 
     def flush_if_full(self):
-        if len(self.rows) > self.BUFFER_SIZE:
+        if self.row_count >= self.buffer_size:
             self.flush()
 
 
 
-class BufferedMatchedCommitmentInserter(BufferedInserter):
-    def __init__(self, connection):
-        BufferedInserter.__init__(self, connection, """
-        INSERT INTO matched_commitment (recipient_id, issuer_id, promise_id, value)
-        VALUES (%s)
-        """)
+def format_copy_value(value):
+    # Numbers need no escaping, and are by far the most common.
+    if isinstance(value, (int, long, Decimal)):
+        return str(value)
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+
+class BufferedMatchedCommitmentWriter(BufferedCopyWriter):
+    def __init__(self, connection, buffer_size=None):
+        BufferedCopyWriter.__init__(
+            self, connection, 'matched_commitment',
+            ['recipient_id', 'issuer_id', 'promise_id', 'value'], buffer_size)
 
 
 
 def commitment2bond(recipient_id, issuer_id, promise_id, value):
     if value>=0:
-        return pair2str(recipient_id, 0), pair2str(issuer_id, promise_id), value
+        return pair2int(recipient_id, 0), pair2int(issuer_id, promise_id), value
     else:
-        return pair2str(issuer_id, promise_id), pair2str(recipient_id, 0), -value
+        return pair2int(issuer_id, promise_id), pair2int(recipient_id, 0), -value
 
 
 
 def bond2commitment(buyer, seller, max_value):
-    buyer_id, buyer_slot_id = str2pair(buyer)
-    seller_id, seller_slot_id = str2pair(seller)
+    buyer_id, buyer_slot_id = int2pair(buyer)
+    seller_id, seller_slot_id = int2pair(seller)
     if seller_slot_id==0:
         assert buyer_slot_id!=0
         return seller_id, buyer_id, buyer_slot_id, -max_value
@@ -135,9 +342,16 @@ def bond2commitment(buyer, seller, max_value):
 
 
 def parse_args(argv):
-    global dsn, no_cluster, level
+    global dsn, no_cluster, level, jobs, engine, copy_rows, bulk_write, report, dry_run
+    global time_budget, mmap_dir, rebuild_commitments
+    global cluster_budget, cluster_threshold
+    global housekeeping_budget, housekeeping_batch_size
     try:                                
-        opts, args = getopt.gnu_getopt(argv, 'hn', ['dsn=', 'level=', 'help', 'no-cluster'])
+        opts, args = getopt.gnu_getopt(argv, 'hnb', [
+                'dsn=', 'level=', 'jobs=', 'engine=', 'copy-rows=', 'help', 'no-cluster',
+                'bulk-write', 'report=', 'cluster-budget=', 'cluster-threshold=',
+                'housekeeping-budget=', 'housekeeping-batch-size=', 'dry-run',
+                'time-budget=', 'mmap-dir=', 'rebuild-commitments'])
     except getopt.GetoptError:
         print(USAGE)
         sys.exit(2)
@@ -158,37 +372,433 @@ def parse_args(argv):
             except ValueError:
                 print(USAGE)
                 sys.exit(2)
+        elif opt == '--mmap-dir':
+            mmap_dir = arg
+        elif opt == '--time-budget':
+            try:
+                time_budget = max(float(arg), 0.0)
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--engine':
+            if arg not in ENGINES:
+                print(USAGE)
+                sys.exit(2)
+            engine = arg
+        elif opt == '--jobs':
+            try:
+                jobs = int(arg)
+                if jobs < 1:
+                    raise ValueError
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--copy-rows':
+            try:
+                copy_rows = int(arg)
+                if copy_rows < 1:
+                    raise ValueError
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--housekeeping-budget':
+            try:
+                housekeeping_budget = max(float(arg), 0.0)
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--housekeeping-batch-size':
+            try:
+                housekeeping_batch_size = int(arg)
+                if housekeeping_batch_size < 1:
+                    raise ValueError
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--cluster-budget':
+            try:
+                cluster_budget = max(float(arg), 0.0)
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--cluster-threshold':
+            try:
+                cluster_threshold = max(float(arg), 0.0)
+            except ValueError:
+                print(USAGE)
+                sys.exit(2)
+        elif opt == '--report':
+            report = arg
+        elif opt == '--dry-run':
+            dry_run = True
+        elif opt == '--rebuild-commitments':
+            rebuild_commitments = True
+        elif opt in ('-b', '--bulk-write'):
+            bulk_write = True
         elif opt in ('-n', '--no-cluster'):
             no_cluster = True
 
 
 
-def cluster():
-    o = curiousorm.Connection(dsn, dictrows=True)
-    o.execute('CLUSTER')
-    o.close()
+class TurnStats:
+    """Collects the durations, the row counts, and the memory usage of turn's stages.
+
+    >>> stats = TurnStats()
+    >>> stats.add_stage('match_commitments', 1.5, 10)
+    >>> stats.add_stage('write_deals', 2.0)
+    >>> stats.add_stage('match_commitments', 0.5, 5)
+    >>> [(s['stage'], s['seconds'], s['row_count']) for s in stats.stages]
+    [('match_commitments', 2.0, 15), ('write_deals', 2.0, None)]
+
+    The report is written in JSON format:
+    >>> import os, tempfile
+    >>> fd, filename = tempfile.mkstemp()
+    >>> stats.write_report(filename, cleared_value=Decimal('1.50'))
+    >>> report = json.load(open(filename))
+    >>> os.close(fd); os.remove(filename)
+    >>> sorted(report), report['cleared_value']
+    ([u'cleared_value', u'stages'], u'1.50')
+    >>> sorted(report['stages'][0])
+    [u'peak_rss_kb', u'row_count', u'seconds', u'stage']
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        stage = {'stage': name, 'row_count': None}
+        started_at = time()
+        yield stage
+        self.add_stage(name, time() - started_at, stage['row_count'])
+
+    def add_stage(self, name, seconds, row_count=None):
+        peak_rss_kb = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+        # A stage that is performed more than once is accounted for
+        # only once, with the sum of the durations and row counts.
+        for stage in self.stages:
+            if stage['stage'] == name:
+                stage['seconds'] += seconds
+                if row_count is not None:
+                    stage['row_count'] = (stage['row_count'] or 0) + row_count
+                stage['peak_rss_kb'] = peak_rss_kb
+                return
+
+        self.stages.append({
+            'stage': name,
+            'seconds': seconds,
+            'row_count': row_count,
+            'peak_rss_kb': peak_rss_kb,
+            })
+
+    def save(self, db):
+        turn_id = db.execute('SELECT MAX(id) FROM turn', onerow=True)
+        with db.Transaction() as trx:
+            for stage in self.stages:
+                trx.insert_turn_stats(turn_id=turn_id, **stage)
+        return turn_id
+
+    def write_report(self, filename, **info):
+        info['stages'] = self.stages
+        with open(filename, 'w') as f:
+            json.dump(info, f, indent=2, default=str)
+
+
+
+@curiousorm.retry_on_deadlock
+def perform_housekeeping_batch(db, crowded_recipient_ids):
+    # Users' transactions run concurrently, so deadlocks are possible.
+    return db._perform_housekeeping_batch_list(housekeeping_batch_size, crowded_recipient_ids)
+
+
+
+def perform_housekeeping(db):
+    # Housekeeping is performed in batches, each batch in its own
+    # transaction, until there is nothing left to do, the time budget
+    # is exhausted, or the next trading turn starts.
+    started_at = time()
+    crowded_recipient_ids = db._get_crowded_recipient_ids()
+    processed_counts = {}
+    while True:
+        rows = perform_housekeeping_batch(db, crowded_recipient_ids)
+        if not rows:
+            print('Housekeeping: postponed, a trading turn is running')
+            break
+        is_done = True
+        for row in rows:
+            category, processed_count = row['category'], row['processed_count']
+            processed_counts[category] = processed_counts.get(category, 0) + processed_count
+            is_done = is_done and processed_count < housekeeping_batch_size
+        if is_done:
+            break
+        if time() - started_at >= housekeeping_budget:
+            print('Housekeeping: postponed, no time left')
+            break
+    for category in sorted(processed_counts):
+        print('Housekeeping: %s %i' % (category, processed_counts[category]))
+    return sum(processed_counts.values())
+
+
+
+def update_user_limits(db):
+    # Traders are updated in batches, each batch in its own
+    # transaction, so that "trader_status" does not stay locked for
+    # long.
+    updated_count = 0
+    while True:
+        n = db._update_user_limits_batch(USER_LIMITS_BATCH_SIZE)
+        updated_count += n
+        if n < USER_LIMITS_BATCH_SIZE:
+            break
+    return updated_count
 
 
 
-def match_commitments(db):
-    bonds = (commitment2bond(*c) for c in commitments())
-    matcher = BondMatcher(10**level)
-    for buyer, seller, amount in bonds:
-        matcher.register_bond(buyer, seller, int(amount.scaleb(2)))
-    matcher.start()
-    matched_commitments = BufferedMatchedCommitmentInserter(db)
+def perform_maintenance(db, stats):
+    # These stages need not be atomic with the trading turn, so they
+    # are performed after the solver has been unlocked, while the
+    # site serves users' requests. (Notifications only update
+    # timestamps. Every batch of user limits locks "trader_status"
+    # before it locks any rows, so it can not deadlock with users'
+    # transactions. Housekeeping batches lock rows the same way
+    # users' transactions do, and stop when the next turn starts.)
+    if not db._lock_maintenance():
+        print('Maintenance: skipped, another maintenance job is running')
+        return
+    try:
+        with stats.stage('schedule_notifications'):
+            db._schedule_notifications()
+        with stats.stage('update_user_limits') as stage:
+            stage['row_count'] = update_user_limits(db)
+        with stats.stage('perform_housekeeping') as stage:
+            stage['row_count'] = perform_housekeeping(db)
+    finally:
+        db._unlock_maintenance()
 
+
+
+def cluster():
+    # Tables are clustered one at a time, those clustered longest ago
+    # first, while the solver is locked (CLUSTER locks the table
+    # exclusively). A table is clustered only if that is expected to
+    # finish within the time budget. Tables that have not changed
+    # enough since they were last clustered are skipped.
+    started_at = time()
+    clustered_count = 0
+    clustered_size = 0
+    clustered_seconds = 0.0
+    o = curiousorm.Connection(dsn, dictrows=True)
+    try:
+        o.execute("SET lock_timeout TO '10s'")
+        for t in o.execute('SELECT table_name, bloat, total_size FROM cluster_candidate '
+                           'ORDER BY last_cluster_ts, bloat DESC'):
+            table_name, bloat, total_size = t['table_name'], t['bloat'], t['total_size']
+            if bloat < cluster_threshold:
+                continue
+            if clustered_seconds > 0.0:
+                bytes_per_second = clustered_size / clustered_seconds
+            else:
+                bytes_per_second = CLUSTER_BYTES_PER_SECOND
+            if time() - started_at + total_size / bytes_per_second > cluster_budget:
+                print('CLUSTER %s (bloat %.2f): postponed, no time left' % (table_name, bloat))
+                continue
+            table_started_at = time()
+            try:
+                o.execute('CLUSTER "%s"' % table_name.replace('"', '""'))
+            except curiousorm.PgError as e:
+                print('CLUSTER %s (bloat %.2f): failed, %s' % (table_name, bloat, e.pgcode))
+                continue
+            o._record_clustered_table(table_name)
+            clustered_count += 1
+            clustered_size += total_size
+            clustered_seconds += time() - table_started_at
+            print('CLUSTER %s (bloat %.2f): %.1f seconds' % (
+                    table_name, bloat, time() - table_started_at))
+    finally:
+        o.close()
+    return clustered_count
+
+
+
+def get_matching_rate(db):
+    # Returns the average number of seconds that matching took per
+    # bond during the last trading turns, or "None" if unknown.
+    rows = db.execute("""
+        SELECT stage, SUM(seconds) AS seconds, SUM(row_count)::float AS row_count
+        FROM turn_stats
+        WHERE
+          turn_id IN (
+            SELECT id FROM turn
+            ORDER BY id DESC
+            LIMIT %s
+          ) AND
+          stage IN ('load_commitments', 'start_matcher', 'match_commitments',
+                    'write_matched_commitments')
+        GROUP BY stage
+        """, (MATCHING_HISTORY_TURN_COUNT,))
+    seconds = sum(r['seconds'] for r in rows)
+    bond_counts = [r['row_count'] for r in rows if r['stage'] == 'start_matcher']
+    if bond_counts and bond_counts[0] > 0:
+        return seconds / bond_counts[0]
+    return None
+
+
+
+def get_bond_counts(db, table='commitment'):
+    """Returns a list, whose N-th element is the number of commitments
+    with value of at least 10**N cents. Those would become bonds
+    with MCV level N.
+
+    >>> class Db:
+    ...     def execute(self, query):
+    ...         return [{'magnitude': 0, 'commitment_count': 5},
+    ...                 {'magnitude': 2, 'commitment_count': 1}]
+    >>> get_bond_counts(Db())
+    [6, 1, 1]
+    """
+
+    rows = db.execute("""
+        SELECT LENGTH((ABS(value) * 100)::bigint::text) - 1 AS magnitude, COUNT(*) AS commitment_count
+        FROM %s
+        WHERE value <> 0
+        GROUP BY magnitude
+        """ % table)
+    counts = [0] * (max([r['magnitude'] for r in rows] or [0]) + 1)
+    for r in rows:
+        counts[r['magnitude']] = r['commitment_count']
+    for n in xrange(len(counts) - 2, -1, -1):
+        counts[n] += counts[n + 1]
+    return counts
+
+
+
+def estimate_matching_seconds(rate, bond_counts, mcv_level):
+    return rate * (bond_counts[mcv_level] if mcv_level < len(bond_counts) else 0)
+
+
+
+def choose_level(rate, bond_counts, seconds, min_level):
+    """Returns the lowest MCV level, not lower than "min_level", for
+    which the matching is expected to take no more than "seconds".
+
+    >>> bond_counts = [6000, 1000, 10]
+    >>> choose_level(0.001, bond_counts, 2.0, 0)
+    1
+    >>> choose_level(0.001, bond_counts, 2.0, 2)
+    2
+    >>> choose_level(0.001, bond_counts, 0.001, 0)
+    3
+
+    Without timings from previous turns, "min_level" is chosen:
+    >>> choose_level(None, bond_counts, 2.0, 0)
+    0
+    """
+
+    if rate is None:
+        return min_level
+    mcv_level = min_level
+    while mcv_level < len(bond_counts) and estimate_matching_seconds(rate, bond_counts, mcv_level) > seconds:
+        mcv_level += 1
+    return mcv_level
+
+
+
+def match_commitments(db, stats, table='commitment', dry_run=False):
+    started_at = time()
+    matched_commitments = BufferedMatchedCommitmentWriter(db, copy_rows)
+    if time_budget is None:
+        mcv_level = level
+        matched_amounts = None
+    else:
+        rate = get_matching_rate(db)
+        bond_counts = get_bond_counts(db, table)
+        mcv_level = choose_level(rate, bond_counts, time_budget, level)
+        matched_amounts = {}
+
+    deal_count = 0
+    cleared_value = 0
     while True:
-        deal = matcher.find_deal()
-        if not deal:
+        print('Matching commitments: MCV=%s' % Decimal(10**mcv_level).scaleb(-2))
+        n, value = run_matcher(db, stats, table, mcv_level, matched_commitments, matched_amounts, dry_run)
+        deal_count += n
+        cleared_value += value
+
+        # When the matching finishes early, the unmatched amounts are
+        # matched again with a lower MCV, if there is time for that.
+        if time_budget is None or mcv_level <= level:
+            break
+        seconds_left = time_budget - (time() - started_at)
+        if estimate_matching_seconds(rate, bond_counts, mcv_level - 1) > seconds_left:
             break
-        path, amount = deal[0], Decimal(deal[1]).scaleb(-2)
-        matched_bonds = [(path[i-1], path[i], amount) for i in range(len(path))]
-        for b in matched_bonds:
-            matched_commitments.insert(bond2commitment(*b), flush_if_full=False)
-        matched_commitments.flush_if_full()
+        mcv_level -= 1
 
-    matched_commitments.flush()
+    # Writing matched commitments is interleaved with the matching,
+    # so it is accounted for separately.
+    stats.stages[-1]['seconds'] -= matched_commitments.seconds
+    stats.add_stage(
+        'write_matched_commitments', matched_commitments.seconds,
+        matched_commitments.written_row_count)
+    return deal_count, Decimal(cleared_value).scaleb(-2), mcv_level
+
+
+
+def run_matcher(db, stats, table, mcv_level, matched_commitments, matched_amounts=None, dry_run=False):
+    # Matches the commitments once, with the given MCV level. If
+    # "matched_amounts" is given, it is used to exclude the amounts
+    # matched by previous runs, and is updated with the new deals.
+    if jobs > 1:
+        matcher = ParallelBondMatcher(10**mcv_level, jobs, ENGINES[engine], mmap_dir)
+    else:
+        matcher = ENGINES[engine](10**mcv_level, mmap_dir)
+    with stats.stage('load_commitments') as stage:
+        stage['row_count'] = load_commitments(db, matcher, table, matched_amounts)
+    with stats.stage('start_matcher') as stage:
+        matcher.start()
+        stage['row_count'] = matcher.get_bond_count()
+
+    with stats.stage('match_commitments') as stage:
+        deal_count = 0
+        cleared_value = 0
+        while True:
+            deal = matcher.find_deal()
+            if not deal:
+                break
+            deal_count += 1
+            cleared_value += len(deal[0]) * deal[1]
+            if matched_amounts is not None:
+                path = deal[0]
+                for i in range(len(path)):
+                    b = (path[i-1], path[i])
+                    matched_amounts[b] = matched_amounts.get(b, 0) + deal[1]
+            if not dry_run:
+                path, amount = deal[0], Decimal(deal[1]).scaleb(-2)
+                matched_bonds = [(path[i-1], path[i], amount) for i in range(len(path))]
+                for b in matched_bonds:
+                    matched_commitments.insert(bond2commitment(*b), flush_if_full=False)
+                matched_commitments.flush_if_full()
+
+        matched_commitments.flush()
+        stage['row_count'] = deal_count
+    return deal_count, cleared_value
+
+
+
+def perform_dry_run(db, stats):
+    # Everything happens in a single REPEATABLE READ transaction, so that
+    # the commitments are calculated from a consistent snapshot, and
+    # only a temporary table gets written to the database.
+    with db.Transaction() as trx:
+        trx.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        with stats.stage('prepare_commitments'):
+            trx.execute("""
+                CREATE TEMPORARY TABLE dry_run_commitment ON COMMIT DROP AS
+                SELECT recipient_id, issuer_id, promise_id, value
+                FROM enabled_candidate_commitment
+                """)
+        return match_commitments(trx, stats, table='dry_run_commitment', dry_run=True)
 
 
 
@@ -196,24 +806,95 @@ if __name__ == "__main__":
     # Read command-line parameters.
     dsn = CMBARTER_DSN
     level = 0
+    jobs = 1
+    engine = 'greedy'
+    copy_rows = BufferedCopyWriter.BUFFER_SIZE
     no_cluster = False
+    housekeeping_budget = 600.0
+    housekeeping_batch_size = 10000
+    cluster_budget = 60.0
+    cluster_threshold = 0.2
+    bulk_write = False
+    report = None
+    dry_run = False
+    time_budget = None
+    mmap_dir = None
+    rebuild_commitments = False
     parse_args(sys.argv[1:])
 
-    # See if we should perform a trading turn.
     db = curiousorm.Connection(dsn, dictrows=True)
+    stats = TurnStats()
+
+    # A dry run does not touch the solver.
+    if dry_run:
+        try:
+            deal_count, cleared_value, mcv_level = perform_dry_run(db, stats)
+        finally:
+            db.close()
+        summary = {'deals': deal_count, 'cleared_value': cleared_value, 'level': mcv_level}
+        if report:
+            stats.write_report(report, **summary)
+        summary['stages'] = stats.stages
+        print(json.dumps(summary, indent=2, default=str))
+        sys.exit()
+
+    # See if we should perform a trading turn.
     should_perform_a_trading_turn = db._lock_solver()  # will block if other process has the lock
     try:
-        # "should_perform_a_trading_turn" can be False if the time for
-        # the next trading turn has not yet come; or if the solver has
-        # not been explicitly unlocked due to a prior server-crash.
+        try:
+            # "should_perform_a_trading_turn" can be False if the time for
+            # the next trading turn has not yet come; or if the resuming
+            # of a crashed turn has been given up. It is True if the
+            # previous turn has been interrupted by a crash, in which case
+            # the turn is resumed from the last completed stage.
+            if should_perform_a_trading_turn!=True:
+                if db.execute('SELECT status FROM solver', onerow=True) == 1:
+                    sys.stderr.write(
+                        'The interrupted trading turn has been resumed too many times, '
+                        'and will not be completed.\n')
+            else:
+                checkpoint = db.execute('SELECT checkpoint FROM solver', onerow=True)
+                if checkpoint > CHECKPOINT_NONE:
+                    print('Resuming the trading turn from checkpoint %i' % checkpoint)
+                if checkpoint < CHECKPOINT_PREPARED:
+                    with stats.stage('prepare_commitments'):
+                        if rebuild_commitments:
+                            db.execute('UPDATE solver SET commitments_are_stale=TRUE')
+                        db._prepare_commitments()
+                if checkpoint < CHECKPOINT_MATCHED:
+                    if checkpoint == CHECKPOINT_PREPARED:
+                        db._clear_matched_commitments()
+                    match_commitments(db, stats)
+                    db._set_solver_checkpoint(CHECKPOINT_MATCHED)
+                if checkpoint < CHECKPOINT_WRITTEN:
+                    with stats.stage('write_deals'):
+                        if bulk_write:
+                            db._write_deals_in_bulk()
+                        else:
+                            db._write_deals()
+                if not no_cluster:
+                    with stats.stage('cluster') as stage:
+                        stage['row_count'] = cluster()
+        except KeyboardInterrupt:
+            # The solver stays locked, so that the next execution
+            # resumes the turn instead of starting it over.
+            if should_perform_a_trading_turn==True:
+                db._suspend_solver()
+            else:
+                db._unlock_solver()
+            raise
+        except:
+            # Errors would most probably happen again if the turn was
+            # resumed, so the turn is abandoned.
+            db._unlock_solver()
+            raise
+        else:
+            db._unlock_solver()
+
         if should_perform_a_trading_turn==True:
-            db._prepare_commitments()
-            match_commitments(db)
-            db._write_deals()
-            db._perform_housekeeping()
-            db._schedule_notifications()
-            db._update_user_limits()
-            no_cluster or cluster()
+            perform_maintenance(db, stats)
+            turn_id = stats.save(db)
+            if report:
+                stats.write_report(report, turn_id=turn_id)
     finally:
-        db._unlock_solver()
         db.close()
@@ -59,6 +59,11 @@ CREATE DOMAIN seqnum AS int CHECK (VALUE BETWEEN 1 AND 999999999);
 CREATE TABLE solver (
   is_unique boolean PRIMARY KEY CHECK (is_unique=TRUE),
   status int NOT NULL CHECK (status >= 0),  -- 0: serving users; 1: performing turn
+  checkpoint int NOT NULL DEFAULT 0 CHECK (checkpoint BETWEEN 0 AND 3),  -- the last completed stage of the turn:
+                                                                         -- 0: none; 1: commitments prepared;
+                                                                         -- 2: commitments matched; 3: deals written
+  resume_count int NOT NULL DEFAULT 0 CHECK (resume_count >= 0),  -- how many times the turn has been resumed
+  commitments_are_stale boolean NOT NULL DEFAULT TRUE,  -- the "commitment" table must be rebuilt during the next turn
   turn_interval interval NOT NULL CHECK (turn_interval >= interval '1 second'),
   next_turn_start_ts timestamp with time zone NOT NULL,
   db_schema_version int NOT NULL CHECK (db_schema_version > 0)
@@ -522,17 +527,9 @@ CLUSTER whitelist_entry USING whitelist_entry_trader_idx;
 -- needed during the turn-generation.
 ----------------------------------------------------------------------
 
-DROP TABLE IF EXISTS commitment CASCADE;
 DROP TABLE IF EXISTS matched_commitment CASCADE;
-
--- Signifies an input egde for the graph.
-CREATE TABLE commitment (
-  recipient_id int NOT NULL,
-  issuer_id int NOT NULL,
-  promise_id int NOT NULL,
-  value value NOT NULL,  -- equals (price * amount)
-  ordering_number float
-);
+DROP TABLE IF EXISTS turn_stats CASCADE;
+DROP TABLE IF EXISTS clustered_table CASCADE;
 
 -- Signifies a successfully matched egde in the graph.
 CREATE TABLE matched_commitment (
@@ -542,6 +539,26 @@ CREATE TABLE matched_commitment (
   value value NOT NULL
 );
 
+-- Signifies a completed stage of a trading turn. "row_count" is the
+-- number of processed rows, if applicable to the stage.
+CREATE TABLE turn_stats (
+  turn_id int NOT NULL REFERENCES turn,
+  stage text NOT NULL,
+  seconds float NOT NULL,
+  row_count bigint,
+  peak_rss_kb bigint NOT NULL,  -- the peak memory usage of the process so far
+  PRIMARY KEY (turn_id, stage)
+);
+
+-- Signifies that a table has been clustered after a trading turn.
+-- "changed_row_count" is the number of inserted, updated, and deleted
+-- rows, as reported by "pg_stat_user_tables" at that time.
+CREATE TABLE clustered_table (
+  table_name name PRIMARY KEY,
+  last_cluster_ts timestamp with time zone NOT NULL,
+  changed_row_count bigint NOT NULL
+);
+
 ----------------------------------------------------------------------
 -- Relations in the following section represent information related to
 -- sending emails to users.
@@ -597,6 +614,10 @@ CREATE TABLE outgoing_notification (
 
 DROP TABLE IF EXISTS mv_recent_deal CASCADE;
 DROP TABLE IF EXISTS mv_asset CASCADE;
+DROP TABLE IF EXISTS commitment CASCADE;
+DROP TABLE IF EXISTS changed_commitment CASCADE;
+DROP TABLE IF EXISTS changed_offer CASCADE;
+DROP TABLE IF EXISTS changed_issuer CASCADE;
 
 -- This is the same as "recent_deal", only indexed and clustered
 -- differently.
@@ -630,3 +651,35 @@ CREATE TABLE mv_asset (
 )
 WITH (FILLFACTOR=75);
 CLUSTER mv_asset USING mv_asset_pkey;
+
+-- Signifies an input egde for the graph. This is the same as the
+-- "enabled_candidate_commitment" view. The triggers record which commitments might have
+-- changed, and "_prepare_commitments" updates only those.
+CREATE TABLE commitment (
+  recipient_id int NOT NULL,
+  issuer_id int NOT NULL,
+  promise_id int NOT NULL,
+  value value NOT NULL  -- equals (price * amount)
+);
+CREATE INDEX commitment_key_idx ON commitment (issuer_id, promise_id, recipient_id);
+
+-- Signifies that the commitment with the given key might have
+-- changed since the last trading turn.
+CREATE TABLE changed_commitment (
+  recipient_id int NOT NULL,
+  issuer_id int NOT NULL,
+  promise_id int NOT NULL
+);
+
+-- Signifies that the commitments for the given product might have
+-- changed since the last trading turn.
+CREATE TABLE changed_offer (
+  issuer_id int NOT NULL,
+  promise_id int NOT NULL
+);
+
+-- Signifies that the commitments for the given issuer's products
+-- might have changed since the last trading turn.
+CREATE TABLE changed_issuer (
+  issuer_id int NOT NULL
+);
@@ -559,9 +559,21 @@ BEGIN
   PERFORM pg_advisory_lock(1);
 
   UPDATE solver
-  SET status=1
+  SET status=1, checkpoint=0, resume_count=0
   WHERE status=0 AND CURRENT_TIMESTAMP >= next_turn_start_ts;
 
+  IF FOUND THEN
+    RETURN TRUE;
+  END IF;
+
+  -- The solver is still locked if the process that performed the
+  -- previous turn died. The turn is resumed from its last
+  -- checkpoint, but not more than 3 times -- a turn that kills the
+  -- process every time should not block the users forever.
+  UPDATE solver
+  SET resume_count=resume_count + 1
+  WHERE status=1 AND resume_count < 3;
+
   RETURN FOUND;
 
 END;
@@ -569,30 +581,210 @@ $$
 LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION _set_solver_checkpoint(_checkpoint int)
+RETURNS boolean AS $$
+BEGIN
+  UPDATE solver
+  SET checkpoint=_checkpoint
+  WHERE status=1;
+
+  RETURN FOUND;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _suspend_solver()
+RETURNS void AS $$
+BEGIN
+  -- Unlike "_unlock_solver", leaves the solver locked, so that the
+  -- next execution of the turn resumes from the last checkpoint. This
+  -- should be used only when the turn gets interrupted for reasons
+  -- that are not related to the data (by the administrator, for
+  -- example).
+  PERFORM pg_advisory_unlock(1);
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _lock_maintenance()
+RETURNS boolean AS $$
+BEGIN
+  -- The turn's stages that need not be performed atomically are
+  -- performed after the solver has been unlocked, holding this lock
+  -- instead.
+  RETURN pg_try_advisory_lock(2);
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _holds_maintenance_lock()
+RETURNS boolean AS $$
+BEGIN
+  PERFORM 1
+  FROM pg_locks
+  WHERE
+    locktype='advisory' AND
+    pid=pg_backend_pid() AND
+    classid=0 AND objid=2 AND objsubid=1 AND
+    granted;
+
+  RETURN FOUND;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _unlock_maintenance()
+RETURNS void AS $$
+BEGIN
+  PERFORM pg_advisory_unlock(2);
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _update_commitments()
+RETURNS void AS $$
+BEGIN
+  -- Collects the keys of all commitments that might have changed, and
+  -- calculates them again.
+  DROP TABLE IF EXISTS changed_commitment_key;
+  CREATE TEMPORARY TABLE changed_commitment_key (
+    recipient_id int NOT NULL,
+    issuer_id int NOT NULL,
+    promise_id int NOT NULL
+  ) ON COMMIT DROP;
+
+  WITH
+    cc AS (
+      DELETE FROM changed_commitment
+      RETURNING recipient_id, issuer_id, promise_id
+    ),
+    co AS (
+      DELETE FROM changed_offer
+      RETURNING issuer_id, promise_id
+    ),
+    ci AS (
+      DELETE FROM changed_issuer
+      RETURNING issuer_id
+    )
+  INSERT INTO changed_commitment_key (recipient_id, issuer_id, promise_id)
+  SELECT recipient_id, issuer_id, promise_id FROM cc
+  UNION
+  SELECT b.recipient_id, b.issuer_id, b.promise_id
+  FROM bid b, co
+  WHERE b.issuer_id=co.issuer_id AND b.promise_id=co.promise_id
+  UNION
+  SELECT issuer_id, issuer_id, promise_id FROM co
+  UNION
+  SELECT b.recipient_id, b.issuer_id, b.promise_id
+  FROM bid b, ci
+  WHERE b.issuer_id=ci.issuer_id
+  UNION
+  SELECT o.issuer_id, o.issuer_id, o.promise_id
+  FROM offer o, ci
+  WHERE o.issuer_id=ci.issuer_id
+  UNION
+  SELECT c.recipient_id, c.issuer_id, c.promise_id
+  FROM commitment c, ci
+  WHERE c.issuer_id=ci.issuer_id;
+
+  ANALYZE changed_commitment_key;
+
+  DELETE FROM commitment c
+  USING changed_commitment_key k
+  WHERE
+    c.issuer_id=k.issuer_id AND
+    c.promise_id=k.promise_id AND
+    c.recipient_id=k.recipient_id;
+
+  INSERT INTO commitment (
+    recipient_id, issuer_id, promise_id, value)
+  SELECT
+    cc.recipient_id, cc.issuer_id, cc.promise_id, cc.value
+  FROM changed_commitment_key k, enabled_candidate_commitment cc
+  WHERE
+    cc.recipient_id=k.recipient_id AND
+    cc.issuer_id=k.issuer_id AND
+    cc.promise_id=k.promise_id;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _rebuild_commitments()
+RETURNS void AS $$
+BEGIN
+  -- Calculates all commitments from scratch. This is needed once
+  -- after upgrading from a version that did not maintain the
+  -- "commitment" table between turns, and if the table has somehow
+  -- got out of sync.
+  TRUNCATE commitment, changed_commitment, changed_offer, changed_issuer;
+
+  INSERT INTO commitment (
+    recipient_id, issuer_id, promise_id, value)
+  SELECT
+    cc.recipient_id, cc.issuer_id, cc.promise_id, cc.value
+  FROM enabled_candidate_commitment cc;
+
+  ANALYZE commitment;
+
+  UPDATE solver SET commitments_are_stale=FALSE;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION _prepare_commitments()
 RETURNS boolean AS $$
 BEGIN
   PERFORM 1 FROM solver WHERE status=1 FOR SHARE;
 
   IF FOUND THEN
-    DROP INDEX IF EXISTS commitment_ordering_idx; TRUNCATE commitment;
+    IF (SELECT commitments_are_stale FROM solver) THEN
+      PERFORM _rebuild_commitments();
 
-    INSERT INTO commitment (
-      recipient_id, issuer_id, promise_id, 
-      value, ordering_number)
-    SELECT
-      cc.recipient_id, cc.issuer_id,cc.promise_id,
-      cc.value, RANDOM()
-    FROM candidate_commitment cc, trader_status ts
-    WHERE
-      ts.trader_id=cc.issuer_id AND
-      ts.offers_are_enabled=TRUE;
+    ELSE
+      PERFORM _update_commitments();
 
-    CREATE INDEX commitment_ordering_idx ON commitment (ordering_number);
-    ANALYZE commitment;
+    END IF;
 
     DROP INDEX IF EXISTS matched_commitment_grouping_idx; TRUNCATE matched_commitment;
 
+    PERFORM _set_solver_checkpoint(1);
+
+    RETURN TRUE;
+
+  ELSE
+    RETURN FALSE;
+
+  END IF;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _clear_matched_commitments()
+RETURNS boolean AS $$
+BEGIN
+  -- Discards the matched commitments written by an interrupted
+  -- matching, so that the matching can be restarted.
+  PERFORM 1 FROM solver WHERE status=1 FOR SHARE;
+
+  IF FOUND THEN
+    DROP INDEX IF EXISTS matched_commitment_grouping_idx; TRUNCATE matched_commitment;
+
     RETURN TRUE;
 
   ELSE
@@ -658,9 +850,102 @@ BEGIN
     ALTER TABLE asset ENABLE TRIGGER increase_asset_amount_trig;
     ALTER TABLE asset ENABLE TRIGGER decrease_asset_amount_trig;
 
-    DROP INDEX IF EXISTS commitment_ordering_idx; TRUNCATE commitment;
     DROP INDEX IF EXISTS matched_commitment_grouping_idx; TRUNCATE matched_commitment;
 
+    PERFORM _set_solver_checkpoint(3);
+
+    RETURN TRUE;
+
+  ELSE
+    RETURN FALSE;
+
+  END IF;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _write_deals_in_bulk()
+RETURNS boolean AS $$
+DECLARE 
+  _turn_id int;
+BEGIN
+  -- This function has exactly the same effect as "_write_deals",
+  -- but all deals are written with a handful of set-based
+  -- statements.
+  PERFORM 1 FROM solver WHERE status=1 FOR SHARE;
+
+  IF FOUND THEN
+    INSERT INTO turn (id) VALUES (DEFAULT) RETURNING id INTO _turn_id;
+
+    ALTER TABLE asset DISABLE TRIGGER increase_asset_amount_trig;
+    ALTER TABLE asset DISABLE TRIGGER decrease_asset_amount_trig;
+
+    DROP INDEX IF EXISTS matched_commitment_grouping_idx;
+    CREATE INDEX matched_commitment_grouping_idx ON matched_commitment (issuer_id, promise_id, recipient_id);
+    ANALYZE matched_commitment;
+
+    DROP TABLE IF EXISTS turn_deal;
+    CREATE TEMPORARY TABLE turn_deal ON COMMIT DROP AS
+      SELECT
+        mc.recipient_id, mc.issuer_id, mc.promise_id,
+        CAST(SUM(mc.value)/MIN(o.price) AS float) AS amount, MIN(o.price) AS price,
+        MIN(o.p_epsilon) AS epsilon
+      FROM matched_commitment mc, offer o
+      WHERE o.issuer_id=mc.issuer_id AND o.promise_id=mc.promise_id
+      GROUP BY mc.issuer_id, mc.promise_id, mc.recipient_id;
+
+    PERFORM 1
+    FROM turn_deal d LEFT OUTER JOIN product p ON p.issuer_id=d.issuer_id AND p.promise_id=d.promise_id
+    WHERE p.issuer_id IS NULL;
+
+    IF FOUND THEN
+      RAISE EXCEPTION 'Product not found';
+    END IF;
+
+    INSERT INTO recent_deal (
+      turn_id, recipient_id, issuer_id, promise_id,
+      amount, price, ts)
+    SELECT
+      _turn_id, recipient_id, issuer_id, promise_id,
+      amount, price, CURRENT_TIMESTAMP
+    FROM turn_deal
+    ORDER BY issuer_id, promise_id, recipient_id;
+
+    INSERT INTO asset (
+      recipient_id, issuer_id, promise_id,
+      amount, last_change_ts, epsilon)
+    SELECT
+      recipient_id, issuer_id, promise_id,
+      amount, CURRENT_TIMESTAMP, epsilon
+    FROM turn_deal
+    ORDER BY issuer_id, promise_id, recipient_id
+    ON CONFLICT (issuer_id, promise_id, recipient_id) DO UPDATE
+    SET
+      amount = asset.amount + EXCLUDED.amount,
+      last_change_ts = EXCLUDED.last_change_ts,
+      epsilon = EXCLUDED.epsilon;
+
+    INSERT INTO unconfirmed_deal (
+      turn_id, recipient_id, issuer_id, promise_id,
+      amount, price, ts,
+      title, unit, summary, epsilon)
+    SELECT
+      _turn_id, d.recipient_id, d.issuer_id, d.promise_id,
+      d.amount, d.price, CURRENT_TIMESTAMP,
+      p.title, p.unit, p.summary, p.epsilon
+    FROM turn_deal d, product p
+    WHERE p.issuer_id=d.issuer_id AND p.promise_id=d.promise_id
+    ORDER BY d.issuer_id, d.promise_id, d.recipient_id;
+
+    ALTER TABLE asset ENABLE TRIGGER increase_asset_amount_trig;
+    ALTER TABLE asset ENABLE TRIGGER decrease_asset_amount_trig;
+
+    DROP INDEX IF EXISTS matched_commitment_grouping_idx; TRUNCATE matched_commitment;
+
+    PERFORM _set_solver_checkpoint(3);
+
     RETURN TRUE;
 
   ELSE
@@ -827,6 +1112,387 @@ $$
 LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION _get_crowded_recipient_ids()
+RETURNS int[] AS $$
+BEGIN
+  -- Returns the users having too many unconfirmed transactions.
+  RETURN ARRAY(
+    SELECT recipient_id
+    FROM unconfirmed_transaction
+    GROUP BY recipient_id
+    HAVING COUNT(*) > 1000);
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _perform_housekeeping_batch(
+  _batch_size int,
+  _crowded_recipient_ids int[],
+  OUT category text,
+  OUT processed_count int)
+RETURNS SETOF record AS $$
+DECLARE
+  _ids int[];
+  _turn_ids int[];
+  _recipient_ids int[];
+  _issuer_ids int[];
+  _promise_ids int[];
+  _trader_id int;
+  _issuer_id int;
+  _promise_id int;
+  _recipient_id int;
+BEGIN
+  -- This function does the same work as "_perform_housekeeping", but
+  -- at most "_batch_size" rows (or traders) of every category are
+  -- processed, and the number of processed rows is returned for each
+  -- category. The function should be called repeatedly until all the
+  -- returned counts are less than "_batch_size". The users having too
+  -- many unconfirmed transactions should be obtained once, with
+  -- "_get_crowded_recipient_ids", before the first call.
+  --
+  -- Unlike "_perform_housekeeping", this function is called while
+  -- users' requests are being served, holding the maintenance lock.
+  -- Like the procedures called by users, it must not run during a
+  -- trading turn, so a share lock on the "solver" record is held
+  -- until the end of the transaction. An empty set is returned if a
+  -- turn is running, or if the maintenance lock is not held.
+  IF NOT _holds_maintenance_lock() THEN
+    RETURN;
+  END IF;
+
+  PERFORM 1 FROM solver WHERE status=0 FOR SHARE;
+
+  IF NOT FOUND THEN
+    RETURN;
+  END IF;
+
+  --
+  -- All traders that had been inactive for at least 3 years should
+  -- get some of their stuff deleted in order to save disk space.
+  --
+  SELECT array_agg(t.trader_id) INTO _ids
+  FROM (
+    SELECT ts.trader_id
+    FROM trader_status ts, trader_status_ext tse
+    WHERE 
+      tse.trader_id=ts.trader_id AND
+      tse.banned_until_ts <= CURRENT_TIMESTAMP AND
+      tse.last_recorded_indirect_activity_ts <= CURRENT_TIMESTAMP - INTERVAL '3 years' AND
+      ts.last_recorded_activity_ts <= CURRENT_TIMESTAMP - INTERVAL '3 years'
+    ORDER BY ts.trader_id
+    LIMIT _batch_size
+    FOR UPDATE OF tse
+  ) t;
+
+  category := 'purged_traders';
+  processed_count := COALESCE(array_length(_ids, 1), 0);
+
+  IF processed_count > 0 THEN
+    UPDATE profile
+    SET
+      (full_name, summary, country, postal_code, address, email, phone, fax, www, time_zone, photograph_id)
+      = ('?', '', '', '', '', '', '', '', '', '?', NULL)
+    WHERE trader_id=ANY(_ids);
+
+    DELETE FROM image WHERE trader_id=ANY(_ids);
+
+    DELETE FROM bid WHERE recipient_id=ANY(_ids);
+
+    DELETE FROM trust WHERE recipient_id=ANY(_ids);
+
+    WITH removed_offer AS (
+      DELETE FROM offer
+      WHERE issuer_id=ANY(_ids)
+      RETURNING issuer_id, promise_id
+    )
+    INSERT INTO offer_removal (issuer_id, promise_id)
+    SELECT issuer_id, promise_id FROM removed_offer;
+
+    DELETE FROM asset WHERE issuer_id=ANY(_ids);
+
+    -- The bids of the traders have been deleted already, so there is
+    -- nothing else to do to confirm their transactions.
+    DELETE FROM unconfirmed_transaction WHERE recipient_id=ANY(_ids);
+
+    DELETE FROM delivery_status WHERE recipient_id=ANY(_ids);
+
+    UPDATE trader_status_ext
+    SET banned_until_ts = CURRENT_TIMESTAMP + interval '1000 years'
+    WHERE trader_id=ANY(_ids);
+
+  END IF;
+
+  RETURN NEXT;
+
+  --
+  -- All products that have been removed from users' respective
+  -- price lists for more than 1 month should be deleted.
+  --
+  DELETE FROM product p
+  USING (
+    SELECT issuer_id, promise_id
+    FROM offer_removal
+    WHERE ts <= CURRENT_TIMESTAMP - INTERVAL '1 month'
+    LIMIT _batch_size
+  ) r
+  WHERE p.issuer_id=r.issuer_id AND p.promise_id=r.promise_id;
+
+  category := 'deleted_products';
+  GET DIAGNOSTICS processed_count = ROW_COUNT;
+  RETURN NEXT;
+
+  --
+  -- All negligible assets that have not been changed for 1 month
+  -- should be discarded, if they are not included in the
+  -- recipient's shopping list.  Also, all assets that have not been
+  -- changed for 3 years, if they are not included in the
+  -- recipient's shopping list, should be discarded too -- even if
+  -- they are non-negligible.
+  --
+  -- The assets included in shopping lists are excluded before the
+  -- limit is applied. Otherwise a batch consisting of such assets
+  -- only would delete nothing, and the category would be considered
+  -- done.
+  SELECT array_agg(recipient_id), array_agg(issuer_id), array_agg(promise_id)
+  INTO _recipient_ids, _issuer_ids, _promise_ids
+  FROM (
+    SELECT s.recipient_id, s.issuer_id, s.promise_id
+    FROM asset s
+    WHERE
+      (
+        s.amount <= s.epsilon AND s.last_change_ts <= CURRENT_TIMESTAMP - INTERVAL '1 month'
+        OR 
+        s.last_change_ts <= CURRENT_TIMESTAMP - INTERVAL '3 years'
+      )
+      AND NOT EXISTS(
+        SELECT 1 
+        FROM bid
+        WHERE
+          bid.recipient_id=s.recipient_id AND
+          bid.issuer_id=s.issuer_id AND
+          bid.promise_id=s.promise_id)
+    LIMIT _batch_size
+  ) o;
+
+  category := 'deleted_assets';
+  processed_count := 0;
+
+  IF _recipient_ids IS NOT NULL THEN
+    -- Shopping items are inserted holding a share lock on the
+    -- corresponding "product" record (see "insert_shopping_item"), so
+    -- the assets included in shopping lists meanwhile are not
+    -- deleted.
+    PERFORM 1
+    FROM product p
+    WHERE (p.issuer_id, p.promise_id) IN (
+      SELECT * FROM unnest(_issuer_ids, _promise_ids))
+    ORDER BY p.issuer_id, p.promise_id
+    FOR UPDATE;
+
+    DELETE FROM asset a
+    USING unnest(_recipient_ids, _issuer_ids, _promise_ids)
+      AS o(recipient_id, issuer_id, promise_id)
+    WHERE
+      a.issuer_id=o.issuer_id AND a.promise_id=o.promise_id AND a.recipient_id=o.recipient_id AND
+      NOT EXISTS(
+        SELECT 1 
+        FROM bid
+        WHERE
+          bid.recipient_id=a.recipient_id AND
+          bid.issuer_id=a.issuer_id AND
+          bid.promise_id=a.promise_id)
+      AND (
+        a.amount <= a.epsilon AND a.last_change_ts <= CURRENT_TIMESTAMP - INTERVAL '1 month'
+        OR 
+        a.last_change_ts <= CURRENT_TIMESTAMP - INTERVAL '3 years');
+
+    GET DIAGNOSTICS processed_count = ROW_COUNT;
+
+  END IF;
+
+  RETURN NEXT;
+
+  --
+  -- All "recent transactions" and "recent deals" that are older
+  -- than 1 month should be deleted.
+  --
+  DELETE FROM recent_transaction
+  WHERE ctid=ANY(ARRAY(
+    SELECT ctid
+    FROM recent_transaction
+    WHERE ts <= CURRENT_TIMESTAMP - INTERVAL '1 month'
+    LIMIT _batch_size));
+
+  category := 'deleted_recent_transactions';
+  GET DIAGNOSTICS processed_count = ROW_COUNT;
+  RETURN NEXT;
+
+  DELETE FROM recent_deal
+  WHERE ctid=ANY(ARRAY(
+    SELECT ctid
+    FROM recent_deal
+    WHERE ts <= CURRENT_TIMESTAMP - INTERVAL '1 month'
+    LIMIT _batch_size));
+
+  category := 'deleted_recent_deals';
+  GET DIAGNOSTICS processed_count = ROW_COUNT;
+  RETURN NEXT;
+
+  --
+  -- All "unconfirmed deals" that are older than 1 month should get
+  -- automatically confirmed.
+  --
+  SELECT array_agg(turn_id), array_agg(recipient_id), array_agg(issuer_id), array_agg(promise_id)
+  INTO _turn_ids, _recipient_ids, _issuer_ids, _promise_ids
+  FROM (
+    SELECT turn_id, recipient_id, issuer_id, promise_id 
+    FROM unconfirmed_deal
+    WHERE ts <= CURRENT_TIMESTAMP - INTERVAL '1 month'
+    LIMIT _batch_size
+  ) d;
+
+  category := 'confirmed_deals';
+  processed_count := 0;
+
+  IF _turn_ids IS NOT NULL THEN
+    -- See the comment in "_confirm_deal".
+    PERFORM 1
+    FROM product p
+    WHERE (p.issuer_id, p.promise_id) IN (
+      SELECT * FROM unnest(_issuer_ids, _promise_ids))
+    ORDER BY p.issuer_id, p.promise_id
+    FOR UPDATE;
+
+    WITH confirmed_deal AS (
+      DELETE FROM unconfirmed_deal ud
+      USING unnest(_turn_ids, _recipient_ids, _issuer_ids, _promise_ids)
+        AS d(turn_id, recipient_id, issuer_id, promise_id)
+      WHERE
+        ud.turn_id=d.turn_id AND
+        ud.recipient_id=d.recipient_id AND
+        ud.issuer_id=d.issuer_id AND
+        ud.promise_id=d.promise_id
+      RETURNING ud.recipient_id, ud.issuer_id, ud.promise_id, ud.amount
+    ),
+    updated_bid AS (
+      UPDATE bid
+      SET amount = bid.amount - cd.amount
+      FROM (
+        SELECT recipient_id, issuer_id, promise_id, SUM(amount) AS amount
+        FROM confirmed_deal
+        GROUP BY recipient_id, issuer_id, promise_id
+      ) cd
+      WHERE
+        bid.recipient_id=cd.recipient_id AND
+        bid.issuer_id=cd.issuer_id AND
+        bid.promise_id=cd.promise_id
+    ),
+    updated_status AS (
+      UPDATE trader_status_ext
+      SET last_recorded_indirect_activity_ts = CURRENT_TIMESTAMP
+      WHERE
+        trader_id IN (SELECT issuer_id FROM confirmed_deal) AND
+        last_recorded_indirect_activity_ts <= CURRENT_TIMESTAMP - INTERVAL '1 day'
+    )
+    SELECT COUNT(*) INTO processed_count FROM confirmed_deal;
+
+  END IF;
+
+  RETURN NEXT;
+
+  --
+  -- All delivery orders that are not active and have not been
+  -- reviewed within the last day should be deleted.
+  --
+  DELETE FROM delivery_status ds
+  USING (
+    SELECT recipient_id, order_id
+    FROM delivery_status
+    WHERE
+      is_active=FALSE AND
+      (last_issuer_review_ts IS NULL OR last_issuer_review_ts <= CURRENT_TIMESTAMP - INTERVAL '1 day')
+    LIMIT _batch_size
+  ) o
+  WHERE
+    ds.recipient_id=o.recipient_id AND ds.order_id=o.order_id AND
+    ds.is_active=FALSE AND
+    (ds.last_issuer_review_ts IS NULL OR ds.last_issuer_review_ts <= CURRENT_TIMESTAMP - INTERVAL '1 day');
+
+  category := 'deleted_delivery_orders';
+  GET DIAGNOSTICS processed_count = ROW_COUNT;
+  RETURN NEXT;
+
+  --
+  -- All "delivery_automation" records that does not have the
+  -- necessary amount to make the payment should be re-considered.
+  -- This involves walking through payer's delivery orders, so it is
+  -- done one record at a time.
+  --
+  category := 'reconsidered_payments';
+  processed_count := 0;
+
+  FOR _trader_id, _issuer_id, _promise_id, _recipient_id IN
+    SELECT p.payee_id, p.p_issuer_id, p.p_promise_id, p.payer_id
+    FROM delivery_automation p LEFT OUTER JOIN asset a ON
+      a.issuer_id=p.p_issuer_id AND
+      a.promise_id=p.p_promise_id AND
+      a.recipient_id=p.payer_id
+    WHERE p.p_amount > COALESCE(a.amount, 0.0)
+    LIMIT _batch_size
+
+  LOOP
+    PERFORM _opt_payment(_trader_id, _issuer_id, _promise_id, _recipient_id);
+    processed_count := processed_count + 1;
+
+  END LOOP;
+
+  RETURN NEXT;
+
+  --
+  -- Users having too many unconfirmed transactions should receive
+  -- additional attention -- all their unconfirmed transactions
+  -- older than 1 month get automatically confirmed. The users are
+  -- given by the caller, because confirming some of their
+  -- transactions may leave them with not that many.
+  --
+  WITH confirmed_transaction AS (
+    DELETE FROM unconfirmed_transaction ut
+    USING (
+      SELECT id
+      FROM unconfirmed_transaction
+      WHERE
+        ts <= CURRENT_TIMESTAMP - INTERVAL '1 month' AND
+        recipient_id=ANY(_crowded_recipient_ids)
+      LIMIT _batch_size
+    ) o
+    WHERE ut.id=o.id
+    RETURNING ut.recipient_id, ut.issuer_id, ut.promise_id, ut.amount
+  ),
+  updated_bid AS (
+    UPDATE bid
+    SET amount = bid.amount - ct.amount
+    FROM (
+      SELECT recipient_id, issuer_id, promise_id, SUM(amount) AS amount
+      FROM confirmed_transaction
+      GROUP BY recipient_id, issuer_id, promise_id
+    ) ct
+    WHERE
+      bid.recipient_id=ct.recipient_id AND
+      bid.issuer_id=ct.issuer_id AND
+      bid.promise_id=ct.promise_id
+  )
+  SELECT COUNT(*) INTO processed_count FROM confirmed_transaction;
+
+  category := 'confirmed_transactions';
+  RETURN NEXT;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION _schedule_notifications()
 RETURNS boolean AS $$
 DECLARE
@@ -837,7 +1503,7 @@ DECLARE
 BEGIN
   PERFORM 1 FROM solver WHERE status=1 FOR SHARE;
 
-  IF FOUND THEN
+  IF FOUND OR _holds_maintenance_lock() THEN
     _ni := interval '1 week';  -- must be greater than 1 day
 
     FOR _trader_id, _email, _email_cancellation_code IN
@@ -890,7 +1556,7 @@ RETURNS boolean AS $$
 BEGIN
   PERFORM 1 FROM solver WHERE status=1 FOR SHARE;
 
-  IF FOUND THEN
+  IF FOUND OR _holds_maintenance_lock() THEN
     LOCK TABLE trader_status IN EXCLUSIVE MODE;
 
     UPDATE trader_status
@@ -931,6 +1597,107 @@ $$
 LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION _update_user_limits_batch(_batch_size int)
+RETURNS int AS $$
+DECLARE
+  _trader_ids int[];
+  _updated_count int;
+BEGIN
+  -- This function does the same as "_update_user_limits", but for at
+  -- most "_batch_size" traders, and returns their number. The
+  -- function should be called repeatedly, until the returned number
+  -- is less than "_batch_size".
+  PERFORM 1 FROM solver WHERE status=1 FOR SHARE;
+
+  IF FOUND OR _holds_maintenance_lock() THEN
+    LOCK TABLE trader_status IN EXCLUSIVE MODE;
+
+    SELECT array_agg(t.trader_id) INTO _trader_ids
+    FROM (
+      SELECT trader_id
+      FROM trader_status
+      WHERE last_limits_update_ts <= CURRENT_TIMESTAMP - interval '1 month'
+      LIMIT _batch_size
+    ) t;
+
+    IF _trader_ids IS NULL THEN
+      RETURN 0;
+
+    END IF;
+
+    UPDATE trader_status ts
+    SET
+      max_email_verification_count = 5,
+      max_sent_email_count = 10,
+      max_received_email_count = 1000,
+      max_login_count = 1000,
+      accumulated_transaction_cost = 0.0,
+      max_generated_photograph_id =
+        + 100
+        + COALESCE(ts.last_generated_photograph_id, 0),
+      max_generated_promise_id =
+        + 200
+        + COALESCE(ts.last_generated_promise_id, 0)
+        - c.offer_count
+        - c.offer_removal_count,
+      max_generated_handoff_id =
+        + 3000
+        + COALESCE(ts.last_generated_handoff_id, 0)
+        - c.unconfirmed_receipt_count,
+      max_generated_order_id =
+        + 1000
+        + COALESCE(ts.last_generated_order_id, 0)
+        - c.delivery_status_count,
+      last_limits_update_ts = CURRENT_TIMESTAMP
+    FROM (
+      SELECT
+        t.trader_id,
+        COALESCE(o.n, 0) AS offer_count,
+        COALESCE(r.n, 0) AS offer_removal_count,
+        COALESCE(ur.n, 0) AS unconfirmed_receipt_count,
+        COALESCE(ds.n, 0) AS delivery_status_count
+      FROM
+        unnest(_trader_ids) AS t(trader_id)
+          LEFT OUTER JOIN (
+            SELECT issuer_id, COUNT(*) AS n
+            FROM offer
+            WHERE issuer_id=ANY(_trader_ids)
+            GROUP BY issuer_id
+          ) o ON o.issuer_id=t.trader_id
+          LEFT OUTER JOIN (
+            SELECT issuer_id, COUNT(*) AS n
+            FROM offer_removal
+            WHERE issuer_id=ANY(_trader_ids)
+            GROUP BY issuer_id
+          ) r ON r.issuer_id=t.trader_id
+          LEFT OUTER JOIN (
+            SELECT issuer_id, COUNT(*) AS n
+            FROM unconfirmed_receipt
+            WHERE issuer_id=ANY(_trader_ids)
+            GROUP BY issuer_id
+          ) ur ON ur.issuer_id=t.trader_id
+          LEFT OUTER JOIN (
+            SELECT recipient_id, COUNT(*) AS n
+            FROM delivery_status
+            WHERE recipient_id=ANY(_trader_ids)
+            GROUP BY recipient_id
+          ) ds ON ds.recipient_id=t.trader_id
+    ) c
+    WHERE ts.trader_id=c.trader_id;
+
+    GET DIAGNOSTICS _updated_count = ROW_COUNT;
+    RETURN _updated_count;
+
+  ELSE
+    RETURN 0;
+
+  END IF;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION _unlock_solver()
 RETURNS void AS $$
 DECLARE
@@ -947,9 +1714,8 @@ BEGIN
     n := CEIL(EXTRACT(epoch from CURRENT_TIMESTAMP - ltts) / EXTRACT(epoch from ti));
 
     UPDATE solver
-    SET status=0, next_turn_start_ts=(ltts + n * ti);
+    SET status=0, checkpoint=0, resume_count=0, next_turn_start_ts=(ltts + n * ti);
 
-    DROP INDEX IF EXISTS commitment_ordering_idx; TRUNCATE commitment;
     DROP INDEX IF EXISTS matched_commitment_grouping_idx; TRUNCATE matched_commitment;
 
   END IF;
@@ -961,6 +1727,23 @@ $$
 LANGUAGE plpgsql;
 
 
+CREATE OR REPLACE FUNCTION _record_clustered_table(_table_name name)
+RETURNS void AS $$
+BEGIN
+  INSERT INTO clustered_table (table_name, last_cluster_ts, changed_row_count)
+  SELECT relname, CURRENT_TIMESTAMP, n_tup_ins + n_tup_upd + n_tup_del
+  FROM pg_stat_user_tables
+  WHERE relname=_table_name AND schemaname=current_schema()
+  ON CONFLICT (table_name) DO UPDATE
+  SET
+    last_cluster_ts=EXCLUDED.last_cluster_ts,
+    changed_row_count=EXCLUDED.changed_row_count;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION insert_trader(
   _id int,
   _username text,
@@ -491,6 +491,105 @@ CREATE TRIGGER update_mv_asset_trig AFTER UPDATE ON asset
 
 
 
+----------------------------------------------------------------------
+-- The following code creates trigger functions to record which rows
+-- in the "commitment" table might have changed.
+----------------------------------------------------------------------
+DROP TRIGGER IF EXISTS change_bid_commitment_trig ON bid;
+DROP TRIGGER IF EXISTS change_bid_product_commitment_trig ON bid_product;
+DROP TRIGGER IF EXISTS change_asset_commitment_trig ON asset;
+DROP TRIGGER IF EXISTS update_asset_commitment_trig ON asset;
+DROP TRIGGER IF EXISTS change_offer_commitment_trig ON offer;
+DROP TRIGGER IF EXISTS update_offer_commitment_trig ON offer;
+DROP TRIGGER IF EXISTS change_issuer_commitment_trig ON trader_status;
+
+CREATE OR REPLACE FUNCTION record_changed_commitment()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP='DELETE' THEN
+    INSERT INTO changed_commitment (recipient_id, issuer_id, promise_id)
+    VALUES (OLD.recipient_id, OLD.issuer_id, OLD.promise_id);
+
+  ELSE
+    INSERT INTO changed_commitment (recipient_id, issuer_id, promise_id)
+    VALUES (NEW.recipient_id, NEW.issuer_id, NEW.promise_id);
+
+    IF TG_OP='UPDATE' THEN
+      IF (OLD.recipient_id, OLD.issuer_id, OLD.promise_id) <> (NEW.recipient_id, NEW.issuer_id, NEW.promise_id) THEN
+        INSERT INTO changed_commitment (recipient_id, issuer_id, promise_id)
+        VALUES (OLD.recipient_id, OLD.issuer_id, OLD.promise_id);
+
+      END IF;
+
+    END IF;
+
+  END IF;
+
+  RETURN NULL;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION record_changed_offer()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP='DELETE' THEN
+    INSERT INTO changed_offer (issuer_id, promise_id)
+    VALUES (OLD.issuer_id, OLD.promise_id);
+
+  ELSE
+    INSERT INTO changed_offer (issuer_id, promise_id)
+    VALUES (NEW.issuer_id, NEW.promise_id);
+
+  END IF;
+
+  RETURN NULL;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION record_changed_issuer()
+RETURNS trigger AS $$
+BEGIN
+  INSERT INTO changed_issuer (issuer_id)
+  VALUES (NEW.trader_id);
+
+  RETURN NULL;
+
+END;
+$$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER change_bid_commitment_trig AFTER INSERT OR UPDATE OR DELETE ON bid
+  FOR EACH ROW EXECUTE PROCEDURE record_changed_commitment();
+
+CREATE TRIGGER change_bid_product_commitment_trig AFTER INSERT OR UPDATE OR DELETE ON bid_product
+  FOR EACH ROW EXECUTE PROCEDURE record_changed_commitment();
+
+CREATE TRIGGER change_asset_commitment_trig AFTER INSERT OR DELETE ON asset
+  FOR EACH ROW EXECUTE PROCEDURE record_changed_commitment();
+
+CREATE TRIGGER update_asset_commitment_trig AFTER UPDATE ON asset
+  FOR EACH ROW WHEN (OLD.amount IS DISTINCT FROM NEW.amount)
+  EXECUTE PROCEDURE record_changed_commitment();
+
+CREATE TRIGGER change_offer_commitment_trig AFTER INSERT OR DELETE ON offer
+  FOR EACH ROW EXECUTE PROCEDURE record_changed_offer();
+
+CREATE TRIGGER update_offer_commitment_trig AFTER UPDATE ON offer
+  FOR EACH ROW WHEN (OLD.price IS DISTINCT FROM NEW.price OR OLD.p_epsilon IS DISTINCT FROM NEW.p_epsilon)
+  EXECUTE PROCEDURE record_changed_offer();
+
+CREATE TRIGGER change_issuer_commitment_trig AFTER UPDATE ON trader_status
+  FOR EACH ROW WHEN (OLD.offers_are_enabled IS DISTINCT FROM NEW.offers_are_enabled)
+  EXECUTE PROCEDURE record_changed_issuer();
+
+
+
+
+
 ----------------------------------------------------------------------
 -- The following code creates a trigger function to keep "p_tsvector"
 -- field in the "trust" table updated.
@@ -0,0 +1,73 @@
+-- The author disclaims copyright to this source code.  In place of
+-- a legal notice, here is a poem:
+--
+--   “Epiphany”
+-- 
+--   Deep, unconscious,
+--   self-fulfilling wish:
+--   the true knowledge
+--   is certainly this.
+-- 
+--   Big, certain, and
+--   nutritious dish:
+--   a plain slavery, 
+--   ironically that is.
+-- 
+----------------------------------------------------------------------
+-- This file contains code upgrading the database schema of an
+-- existing installation of the CMB web application. The triggers,
+-- the views, and the stored procedures should be created again
+-- afterwards:
+--
+--   cmbarter=> \i upgrade.sql
+--   cmbarter=> \i triggers.sql
+--   cmbarter=> \i views.sql
+--   cmbarter=> \i sprocs.sql
+--
+-- Executing it more than once is harmless.
+--
+
+-- The "commitment" table gets rebuilt during the next trading turn.
+ALTER TABLE solver
+  ADD COLUMN IF NOT EXISTS commitments_are_stale boolean NOT NULL DEFAULT TRUE;
+
+ALTER TABLE solver
+  ADD COLUMN IF NOT EXISTS checkpoint int NOT NULL DEFAULT 0 CHECK (checkpoint BETWEEN 0 AND 3),
+  ADD COLUMN IF NOT EXISTS resume_count int NOT NULL DEFAULT 0 CHECK (resume_count >= 0);
+
+CREATE TABLE IF NOT EXISTS turn_stats (
+  turn_id int NOT NULL REFERENCES turn,
+  stage text NOT NULL,
+  seconds float NOT NULL,
+  row_count bigint,
+  peak_rss_kb bigint NOT NULL,
+  PRIMARY KEY (turn_id, stage)
+);
+
+CREATE TABLE IF NOT EXISTS clustered_table (
+  table_name name PRIMARY KEY,
+  last_cluster_ts timestamp with time zone NOT NULL,
+  changed_row_count bigint NOT NULL
+);
+
+-- Older versions calculated all commitments from scratch on every
+-- trading turn, storing a random ordering number with every
+-- commitment. Now the "commitment" table is maintained between turns.
+DROP INDEX IF EXISTS commitment_ordering_idx;
+ALTER TABLE commitment DROP COLUMN IF EXISTS ordering_number;
+CREATE INDEX IF NOT EXISTS commitment_key_idx ON commitment (issuer_id, promise_id, recipient_id);
+
+CREATE TABLE IF NOT EXISTS changed_commitment (
+  recipient_id int NOT NULL,
+  issuer_id int NOT NULL,
+  promise_id int NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS changed_offer (
+  issuer_id int NOT NULL,
+  promise_id int NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS changed_issuer (
+  issuer_id int NOT NULL
+);
@@ -100,6 +100,35 @@ CREATE OR REPLACE VIEW candidate_commitment AS
     o.price IS NOT NULL;
 
 
+CREATE OR REPLACE VIEW enabled_candidate_commitment AS 
+  SELECT
+    cc.recipient_id, cc.issuer_id, cc.promise_id,
+    cc.value
+  FROM candidate_commitment cc, trader_status ts
+  WHERE
+    ts.trader_id=cc.issuer_id AND
+    ts.offers_are_enabled=TRUE;
+
+
+-- "bloat" estimates the part of table's rows that have been changed
+-- since the table was last clustered. "total_size" is the size of the
+-- table and its indexes, in bytes.
+CREATE OR REPLACE VIEW cluster_candidate AS 
+  SELECT
+    s.relname AS table_name,
+    CAST(CASE
+      WHEN s.n_tup_ins + s.n_tup_upd + s.n_tup_del >= COALESCE(ct.changed_row_count, 0)
+      THEN s.n_tup_ins + s.n_tup_upd + s.n_tup_del - COALESCE(ct.changed_row_count, 0)
+      ELSE s.n_tup_ins + s.n_tup_upd + s.n_tup_del  -- the statistics have been reset
+    END AS float) / GREATEST(s.n_live_tup, 1) AS bloat,
+    COALESCE(ct.last_cluster_ts, '1900-01-01') AS last_cluster_ts,
+    pg_total_relation_size(s.relid) AS total_size
+  FROM pg_stat_user_tables s LEFT OUTER JOIN clustered_table ct ON ct.table_name=s.relname
+  WHERE
+    s.schemaname=current_schema() AND
+    EXISTS (SELECT 1 FROM pg_index i WHERE i.indrelid=s.relid AND i.indisclustered);
+
+
 CREATE OR REPLACE VIEW delivery_order AS 
   SELECT
     dd.recipient_id, dd.order_id,